@@ -4,22 +4,35 @@
 
 import static java.nio.charset.StandardCharsets.US_ASCII;
 import static java.nio.charset.StandardCharsets.UTF_8;
+import static java.nio.file.StandardOpenOption.CREATE;
+import static java.nio.file.StandardOpenOption.READ;
+import static java.nio.file.StandardOpenOption.WRITE;
 import static java.util.stream.Collectors.toUnmodifiableMap;
 
 import java.awt.Dimension;
 import java.awt.MouseInfo;
+import java.awt.Point;
 import java.awt.Rectangle;
 import java.awt.Robot;
 import java.awt.Toolkit;
 import java.awt.event.InputEvent;
+import java.awt.image.BufferedImage;
 import java.io.ByteArrayOutputStream;
 import java.io.IOException;
 import java.net.InetSocketAddress;
 import java.net.URI;
+import java.net.URLDecoder;
+import java.nio.ByteBuffer;
+import java.nio.ByteOrder;
+import java.nio.MappedByteBuffer;
+import java.nio.channels.FileChannel;
+import java.nio.file.Path;
+import java.util.ArrayList;
 import java.util.Arrays;
 import java.util.List;
 import java.util.Map;
 import java.util.Optional;
+import java.util.stream.Stream;
 
 import javax.imageio.ImageIO;
 
@@ -30,9 +43,11 @@ import com.sun.net.httpserver.spi.HttpServerProvider;
 
 public class MinesweeperPlayer {
     private final Robot robot;
+    private final FrameBuffer frameBuffer;
 
-    public MinesweeperPlayer(Robot robot) {
+    public MinesweeperPlayer(Robot robot, FrameBuffer frameBuffer) {
         this.robot = robot;
+        this.frameBuffer = frameBuffer;
     }
 
     abstract class RequestHandler implements HttpHandler {
@@ -46,10 +61,15 @@ public class MinesweeperPlayer {
                     .orElse("");
 
             try {
-                Map<String, String> qparams = Arrays.stream(query.split("&"))
+                // form encoded POST bodies are read like query parameters
+                String body = URLDecoder.decode(
+                        new String(exchange.getRequestBody().readAllBytes(), US_ASCII),
+                        UTF_8);
+                Map<String, String> qparams = Stream.of(query, body)
+                        .flatMap(params -> Arrays.stream(params.split("&")))
                         .map(kv -> kv.split("="))
                         .filter(kv -> kv.length == 2)
-                        .collect(toUnmodifiableMap(kv -> kv[0], kv -> kv[1]));
+                        .collect(toUnmodifiableMap(kv -> kv[0], kv -> kv[1], (a, b) -> b));
 
                 System.out.println("URI = " + requestURI);
 
@@ -59,6 +79,9 @@ public class MinesweeperPlayer {
                         .write(respData);
             } catch (Exception e) {
                 e.printStackTrace();
+            } finally {
+                // completes the exchange so the connection can be kept alive
+                exchange.close();
             }
         }
 
@@ -100,10 +123,7 @@ public class MinesweeperPlayer {
     private final class MouseClickHandler extends RequestHandler {
         @Override
         protected byte[] handle(Map<String, String> qparams, Headers responseHeaders) {
-            robot.mousePress(InputEvent.BUTTON1_DOWN_MASK);
-            robot.delay(20);
-            robot.mouseRelease(InputEvent.BUTTON1_DOWN_MASK);
-            var location = MouseInfo.getPointerInfo().getLocation();
+            var location = click(qparams.getOrDefault("button", "left"));
 
             responseHeaders.add("Content-Type", "application/json");
 
@@ -117,6 +137,76 @@ public class MinesweeperPlayer {
         }
     }
 
+    /**
+     * Runs a sequence of operations in one request.  The ops parameter is a
+     * ';' separated list of "move,X,Y" and "click,BUTTON".  Responds with
+     * the mouse location after each operation.  Stops early if a move does
+     * not reach its target, so the response has fewer locations than ops.
+     */
+    private final class BatchHandler extends RequestHandler {
+        @Override
+        protected byte[] handle(Map<String, String> qparams, Headers responseHeaders) {
+            var locations = new ArrayList<String>();
+            for (String op : qparams.getOrDefault("ops", "").split(";")) {
+                if (op.isEmpty()) {
+                    continue;
+                }
+                String[] args = op.split(",");
+                Point location = switch (args[0]) {
+                    case "move" -> moveTo(Integer.parseInt(args[1]), Integer.parseInt(args[2]));
+                    case "click" -> click(args.length > 1 ? args[1] : "left");
+                    default -> throw new IllegalArgumentException("Unknown op " + op);
+                };
+                locations.add(String.format("{ \"x\": %d, \"y\": %d }", location.x, location.y));
+                if (args[0].equals("move")
+                        && (location.x != Integer.parseInt(args[1])
+                            || location.y != Integer.parseInt(args[2]))) {
+                    break;
+                }
+            }
+
+            responseHeaders.add("Content-Type", "application/json");
+
+            return ("[" + String.join(", ", locations) + "]\n").getBytes(US_ASCII);
+        }
+    }
+
+    /**
+     * Moves the mouse to (x, y), retrying a few times if it lands elsewhere.
+     */
+    private Point moveTo(int x, int y) {
+        Point location = null;
+        for (int i = 0; i < 10; i++) {
+            robot.mouseMove(x, y);
+            location = MouseInfo.getPointerInfo().getLocation();
+            if (location.x == x && location.y == y) {
+                break;
+            }
+        }
+        return location;
+    }
+
+    private Point click(String button) {
+        int buttons = buttonMask(button);
+        robot.mousePress(buttons);
+        robot.delay(20);
+        robot.mouseRelease(buttons);
+        return MouseInfo.getPointerInfo().getLocation();
+    }
+
+    /**
+     * Mouse buttons for a click: left, right, middle, or both (left and
+     * right together, which chords in most minesweeper games).
+     */
+    static int buttonMask(String button) {
+        return switch (button) {
+            case "right" -> InputEvent.BUTTON3_DOWN_MASK;
+            case "middle" -> InputEvent.BUTTON2_DOWN_MASK;
+            case "both" -> InputEvent.BUTTON1_DOWN_MASK | InputEvent.BUTTON3_DOWN_MASK;
+            default -> InputEvent.BUTTON1_DOWN_MASK;
+        };
+    }
+
     private final class ScreenshotHandler extends RequestHandler {
         private final Dimension screenDims;
 
@@ -139,6 +229,14 @@ public class MinesweeperPlayer {
                 bounds = new Rectangle(screenDims);
             }
             var img = robot.createScreenCapture(bounds);
+            String format = qparams.getOrDefault("format", "png");
+            if (format.equals("raw")) {
+                return raw(img, headers);
+            }
+            if (format.equals("shm") && frameBuffer != null) {
+                headers.add("X-Sequence", Long.toString(frameBuffer.write(img)));
+                return new byte[0];
+            }
             int filesize = img.getWidth() * img.getHeight() * 3;
             var out = new ByteArrayOutputStream(filesize);
 
@@ -147,27 +245,112 @@ public class MinesweeperPlayer {
 
             return out.toByteArray();
         }
+
+        /**
+         * Uncompressed BGRA pixels, row by row.  The X-Width, X-Height,
+         * X-Stride (bytes per row) and X-Channels headers describe the
+         * layout.
+         */
+        private byte[] raw(BufferedImage img, Headers headers) {
+            int w = img.getWidth();
+            int h = img.getHeight();
+            int[] argb = img.getRGB(0, 0, w, h, null, 0, w);
+            var buffer = ByteBuffer.allocate(argb.length * 4)
+                    .order(ByteOrder.LITTLE_ENDIAN);
+            buffer.asIntBuffer().put(argb);
+
+            headers.add("Content-Type", "application/octet-stream");
+            headers.add("X-Width", Integer.toString(w));
+            headers.add("X-Height", Integer.toString(h));
+            headers.add("X-Stride", Integer.toString(w * 4));
+            headers.add("X-Channels", "4");
+
+            return buffer.array();
+        }
+    }
+
+    /**
+     * Ring buffer of frames in a memory mapped file, read by play.py.  The
+     * layout is described in framebuffer.py.
+     */
+    private static final class FrameBuffer {
+        private static final int HEADER = 64;
+        private static final int SLOT_HEADER = 32;
+        private final MappedByteBuffer map;
+        private final int slots;
+        private final int capacity;
+        private long seq;
+
+        FrameBuffer(Path path, int slots, int capacity) throws IOException {
+            this.slots = slots;
+            this.capacity = capacity;
+            try (var channel = FileChannel.open(path, CREATE, READ, WRITE)) {
+                map = channel.map(FileChannel.MapMode.READ_WRITE, 0,
+                        HEADER + (long) slots * (SLOT_HEADER + capacity));
+            }
+            map.order(ByteOrder.LITTLE_ENDIAN);
+            map.put(0, "MSFB".getBytes(US_ASCII));
+            map.putInt(4, 1);
+            map.putInt(8, slots);
+            map.putInt(12, capacity);
+            map.putLong(16, 0);
+        }
+
+        synchronized long write(BufferedImage img) {
+            int w = img.getWidth();
+            int h = img.getHeight();
+            if (w * h * 4 > capacity) {
+                throw new IllegalArgumentException("Frame too large " + w + "x" + h);
+            }
+            int[] argb = img.getRGB(0, 0, w, h, null, 0, w);
+            long next = seq + 1;
+            int base = HEADER + (int) (next % slots) * (SLOT_HEADER + capacity);
+
+            map.putLong(base, 0);
+            map.slice(base + SLOT_HEADER, argb.length * 4)
+                    .order(ByteOrder.LITTLE_ENDIAN)
+                    .asIntBuffer()
+                    .put(argb);
+            map.putInt(base + 8, w);
+            map.putInt(base + 12, h);
+            map.putInt(base + 16, w * 4);
+            map.putInt(base + 20, 4);
+            map.putLong(base, next);
+            map.putLong(16, next);
+            seq = next;
+            return next;
+        }
     }
 
     public static void main(String[] args) throws Exception {
         var argPort = args.length >= 1 ? args[0] : "8888";
         var argDelay = args.length >= 2 ? args[1] : null;
+        var argFrameBuffer = args.length >= 3 ? args[2] : null;
         var robot = new Robot();
         var serverProvider = HttpServerProvider.provider();
         int port = Integer.parseInt(argPort);
 
-        System.out.printf("port=%s delay=%s%n", argPort, argDelay);
+        System.out.printf("port=%s delay=%s framebuffer=%s%n",
+                argPort, argDelay, argFrameBuffer);
         if (argDelay != null) {
             robot.setAutoDelay(Integer.parseInt(argDelay));
         }
         var server = serverProvider.createHttpServer(
                 new InetSocketAddress("localhost", port), 10);
 
-        var player = new MinesweeperPlayer(robot);
+        FrameBuffer frameBuffer = null;
+        if (argFrameBuffer != null) {
+            // three full screen frames
+            var screen = Toolkit.getDefaultToolkit().getScreenSize();
+            frameBuffer = new FrameBuffer(Path.of(argFrameBuffer), 3,
+                    screen.width * screen.height * 4);
+        }
+        var player = new MinesweeperPlayer(robot, frameBuffer);
 
         server.createContext("/screencap", player.new ScreenshotHandler());
         server.createContext("/mousemove", player.new MouseMoveHandler());
         server.createContext("/mouseclick", player.new MouseClickHandler());
+        server.createContext("/batch", player.new BatchHandler());
         server.createContext("/stop", exc -> {
             exc.sendResponseHeaders(200, 4);
             exc.getResponseBody().write("Bye\n".getBytes(UTF_8));
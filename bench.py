@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+"""Headless self-play benchmark: plays simulated games with MineSolver
+on a process pool and reports win rate, guesses and time per move.
+
+    ./bench.py [preset] [games] [workers] [seed]
+
+preset is beginner, intermediate, expert or MxNxMINES (e.g. 30x30x150).
+"""
+
+from concurrent.futures import (
+    ProcessPoolExecutor,
+)
+import random
+import time
+from typing import (
+    List,
+    NamedTuple,
+    Tuple,
+)
+
+import numpy as np
+
+from minesweeper import (
+    Action,
+    Minesweeper,
+    MineSolver,
+    guess,
+    plan_moves,
+)
+
+
+PRESETS = {
+    "beginner": (9, 9, 10),
+    "intermediate": (16, 16, 40),
+    "expert": (16, 30, 99),
+}
+
+
+class GameResult(NamedTuple):
+    seed: int
+    won: bool
+    guesses: int
+    clicks: int
+    move_times_ns: List[int]
+
+
+def new_game(m: int, n: int, minecount: int, seed: int) -> Minesweeper:
+    """A game whose mines are placed by seed, with the centre cell kept
+    free of mines the way real games keep the first click safe."""
+    rng = random.Random(seed)
+    start = (m // 2) * n + n // 2
+    cells = [c for c in range(m * n) if c != start]
+    positions = set(rng.sample(cells, k=minecount))
+    return Minesweeper(m, n, mines=[c in positions for c in range(m * n)])
+
+
+def play_game(args: Tuple[int, int, int, int]) -> GameResult:
+    m, n, minecount, seed = args
+    ms = new_game(m, n, minecount, seed)
+    solver = MineSolver(ms)
+    first = lambda lst: lst[0]  # noqa: E731
+    guesses, clicks = 0, 0
+    move_times_ns: List[int] = []
+    ms.click((m // 2, n // 2), Action.OPEN)
+    clicks += 1
+    try:
+        while True:
+            start = time.perf_counter_ns()
+            unmines = solver.update_board_state(fetch_full_board=False)
+            if unmines:
+                moves, _ = plan_moves(solver, ms, unmines)
+            elif next(solver.unknowns(), None) is None:
+                move_times_ns.append(time.perf_counter_ns() - start)
+                return GameResult(seed, True, guesses, clicks, move_times_ns)
+            else:
+                point, _ = guess(solver, first)
+                moves = [(point, Action.OPEN)]
+                guesses += 1
+            move_times_ns.append(time.perf_counter_ns() - start)
+            for point, action in moves:
+                clicks += 1
+                ms.click(point, action)
+    except ValueError as e:
+        # the solver's own errors are bugs, not lost games
+        if not str(e).startswith("Exploded"):
+            raise
+        return GameResult(seed, False, guesses, clicks, move_times_ns)
+    finally:
+        solver.close()
+
+
+def bench(
+    m: int, n: int, minecount: int, games: int, workers: int, seed: int
+) -> List[GameResult]:
+    args = [(m, n, minecount, seed + i) for i in range(games)]
+    with ProcessPoolExecutor(max_workers=workers or None) as pool:
+        return list(pool.map(play_game, args, chunksize=4))
+
+
+def report(results: List[GameResult], elapsed_s: float) -> str:
+    times_ms = np.array(
+        [t for r in results for t in r.move_times_ns], dtype=np.float64
+    ) / 1e6
+    p50, p95, p99 = np.percentile(times_ms, [50, 95, 99])
+    games = len(results)
+    wins = sum(1 for r in results if r.won)
+    guesses = sum(r.guesses for r in results)
+    clicks = sum(r.clicks for r in results)
+    return (
+        f"games {games}  won {wins} ({100 * wins / games:.1f}%)"
+        f"  guesses/game {guesses / games:.2f}"
+        f"  clicks/game {clicks / games:.1f}\n"
+        f"moves {len(times_ms)}  ms/move p50 {p50:.2f}"
+        f"  p95 {p95:.2f}  p99 {p99:.2f}  max {times_ms.max():.2f}\n"
+        f"wall time {elapsed_s:.1f}s  games/s {games / elapsed_s:.1f}"
+    )
+
+
+if __name__ == "__main__":
+    import sys
+
+    default_args = 'expert 1000 0 0'.split()
+    args = sys.argv[1:] + default_args[len(sys.argv) - 1:]
+    if args[0] in PRESETS:
+        m, n, minecount = PRESETS[args[0]]
+    else:
+        m, n, minecount = map(int, args[0].split("x"))
+    games, workers, seed = int(args[1]), int(args[2]), int(args[3])
+
+    start_s = time.perf_counter()
+    results = bench(m, n, minecount, games, workers, seed)
+    print(f"{args[0]} {m}x{n} mines={minecount} seed={seed}")
+    print(report(results, time.perf_counter() - start_s))
@@ -1,14 +1,25 @@
 #!/usr/bin/env python3
 
+from collections import (
+    OrderedDict,
+)
 from enum import Enum
+from hashlib import (
+    blake2b,
+)
 from math import (
     ceil,
     floor,
 )
+from threading import (
+    Lock,
+)
 from typing import (
     Any,
     Dict,
     Iterator,
+    Optional,
+    Sequence,
     Tuple,
     TypeVar,
 )
@@ -62,12 +73,21 @@ class FindImage:
         ("CORNER.NE", "find_n_ne.png"), ("CORNER.NW", "find_n_nw.png"),
         ("CORNER.SE", "find_n_se.png"), ("CORNER.SW", "find_n_sw.png")
     ]
+    PYRAMID_SCALE = 3  # most downscaling for the coarse search
+    # the status face is centred over the board, STATUS_ABOVE pixels above
+    # its top edge and STATUS_SIZE pixels a side; None if not known
+    STATUS_ABOVE: Optional[int] = None
+    STATUS_SIZE = 0
+
     def __init__(
             self,
             images: Dict[str, Image],
             height: int, width: int,
             extra_x: int, extra_y: int,
+            cache_size: int = 1024,
     ):
+        """cache_size is the number of cell images identify_cell remembers,
+        0 to disable."""
         self.height, self.width = height, width
         self.xtra_x, self.xtra_y = extra_x, extra_y
         image_cells = dict(
@@ -79,7 +99,7 @@ class FindImage:
         cell_images = [
             (n, i)
             for n, i in images.items()
-            if n == "UNOPENED"
+            if n in ("UNOPENED", "FLAG")
             or n in "12345678"  # "0" excluded
         ]
         end_images = [
@@ -93,6 +113,31 @@ class FindImage:
         self.__end_images: Dict[str, Image] = end_images
         self.__cell_images: Dict[str, Image] = cell_images
         self.__image_cells: Dict[str, Cell] = image_cells
+        self.__cell_names: Dict[Cell, str] = {
+            c: n for n, c in image_cells.items()
+        }
+        self.__stack = FindImage.__stack_templates(
+            [(n, i) for n, i in cell_images], images["0"]
+        )
+        # template positions of the board corners, by corner name
+        self.corners: Optional[Dict[str, Pair[int]]] = None
+        # (x, y, w, h) of the status face, set by get_new_board
+        self.status: Optional[Tuple[int, int, int, int]] = None
+        self.cache_size = cache_size
+        self.cache_hits, self.cache_misses = 0, 0
+        self.__cache: OrderedDict[Tuple, Cell] = OrderedDict()
+        self.__cache_lock = Lock()  # identify_cell may run on threads
+        # templates matched so far, by _match_template and identify_board
+        self.matches = 0
+        self.__matches_lock = Lock()
+
+    def _match_template(
+            self, image: Image, template: Image, algo: int
+    ) -> np.ndarray:
+        "cv2.matchTemplate, counted in self.matches."
+        with self.__matches_lock:
+            self.matches += 1
+        return cv2.matchTemplate(image, template, algo)
 
     def get_matches(
             self,
@@ -102,15 +147,58 @@ class FindImage:
             threshold: float,
             algo: int
     ) -> Pair[np.ndarray]:
-        match = cv2.matchTemplate(image, template, algo)
+        match = self._match_template(image, template, algo)
         ys, xs = np.asarray(match >= threshold).nonzero()
         if len(ys) == 0 or len(xs) == 0:
             raise SubImageNotFoundError(name)
         return xs, ys
 
+    def search(
+            self,
+            image: Image,
+            template: Image,
+            name: str,
+            threshold: float,
+            algo: int = cv2.TM_CCOEFF_NORMED,
+    ) -> Pair[np.ndarray]:
+        """get_matches, coarse to fine.  Candidates are found on copies of
+        image and template scaled down, by up to PYRAMID_SCALE while the
+        template keeps 8 pixels a side, with a looser threshold.  They are
+        then confirmed at full size in a small region around each.  Small
+        templates or images are searched at full size."""
+        th, tw = template.shape[:2]
+        f = min(FindImage.PYRAMID_SCALE, min(th, tw) // 8)
+        if f < 2 or min(image.shape[:2]) < 4 * max(th, tw):
+            return self.get_matches(image, template, name, threshold, algo)
+        small = cv2.resize(
+            image, None, fx=1 / f, fy=1 / f, interpolation=cv2.INTER_AREA
+        )
+        small_template = cv2.resize(
+            template, None, fx=1 / f, fy=1 / f, interpolation=cv2.INTER_AREA
+        )
+        coarse = self._match_template(small, small_template, algo)
+        ys, xs = np.nonzero(coarse >= threshold - 0.25)
+        if len(ys) > 64:
+            best = np.argsort(coarse[ys, xs])[-64:]
+            ys, xs = ys[best], xs[best]
+        found = set()
+        pad = 2 * f
+        for y, x in zip((ys * f).tolist(), (xs * f).tolist()):
+            y0, x0 = max(y - pad, 0), max(x - pad, 0)
+            roi = image[y0:y + th + pad, x0:x + tw + pad]
+            if roi.shape[0] < th or roi.shape[1] < tw:
+                continue
+            fine = self._match_template(roi, template, algo)
+            rys, rxs = np.nonzero(fine >= threshold)
+            found.update(zip((rys + y0).tolist(), (rxs + x0).tolist()))
+        if not found:
+            raise SubImageNotFoundError(name)
+        ys, xs = zip(*sorted(found))
+        return np.array(xs), np.array(ys)
+
     def get_unopened_corner(self, image, corner) -> Pair[np.ndarray]:
         template = self.__all_images[f"CORNER.{corner}"]
-        return self.get_matches(
+        return self.search(
             image,
             template,
             corner,
@@ -122,7 +210,7 @@ class FindImage:
         "Returns True if the game is over; False otherwise."
         for name, template in self.__end_images:
             try:
-                self.get_matches(
+                self.search(
                     image,
                     template,
                     name,
@@ -135,14 +223,51 @@ class FindImage:
 
         return ""
 
+    def shows_mine(self, cell: Image) -> bool:
+        "True if a cell sized image shows the exploded mine."
+        template = self.__all_images["EXPLODED"]
+        if cell.shape[0] < template.shape[0] or cell.shape[1] < template.shape[1]:
+            return False
+        match = self._match_template(cell, template, cv2.TM_CCOEFF_NORMED)
+        return bool(match.max() >= 0.95)
+
+    def corners_match(self, image, corners: Dict[str, Pair[int]]) -> bool:
+        "True if the corner templates are still at the given positions."
+        for corner, (x, y) in corners.items():
+            template = self.__all_images[f"CORNER.{corner}"]
+            th, tw = template.shape[:2]
+            roi = image[y:y + th, x:x + tw]
+            if roi.shape[:2] != (th, tw):
+                return False
+            score = self._match_template(roi, template, cv2.TM_CCOEFF_NORMED)
+            if score[0, 0] < 0.95:
+                return False
+        return True
+
     def get_new_board(self, image) -> Tuple[Tuple[int, int], Any]:
-        ne_x, ne_y = self.get_unopened_corner(image, "NE")
-        nw_x, nw_y = self.get_unopened_corner(image, "NW")
-        se_x, se_y = self.get_unopened_corner(image, "SE")
-        sw_x, sw_y = self.get_unopened_corner(image, "SW")
-        nwx, nwy = int(nw_x[0] + self.xtra_x), int(nw_y[0] + self.xtra_y)
-        board_width = int(ne_x[0] - nwx + self.width)
-        board_height = int(se_y[0] - nwy + self.height)
+        """The top left of the board and the Board.  The corners found are
+        kept in self.corners; while they still match, the search is
+        skipped."""
+        if self.corners is None or not self.corners_match(image, self.corners):
+            self.corners = None
+            corners = {}
+            for corner in ("NE", "NW", "SE", "SW"):
+                xs, ys = self.get_unopened_corner(image, corner)
+                corners[corner] = (int(xs[0]), int(ys[0]))
+            self.corners = corners
+        ne_x, _ = self.corners["NE"]
+        nw_x, nw_y = self.corners["NW"]
+        _, se_y = self.corners["SE"]
+        nwx, nwy = int(nw_x + self.xtra_x), int(nw_y + self.xtra_y)
+        board_width = int(ne_x - nwx + self.width)
+        board_height = int(se_y - nwy + self.height)
+        self.status = None
+        if self.STATUS_ABOVE is not None:
+            size = self.STATUS_SIZE
+            x = nwx + board_width // 2 - size // 2
+            y = nwy - self.STATUS_ABOVE - size // 2
+            if x > 0 and y > 0:
+                self.status = (x, y, size, size)
         return (
             (nwx, nwy),
             Board(
@@ -151,7 +276,97 @@ class FindImage:
             )
         )
 
-    def identify_cell(self, cell: Image) -> Cell:
+    def identify_cell(
+            self,
+            cell: Image,
+            prior: Sequence[Cell] = (),
+            verify: bool = False,
+    ) -> Cell:
+        """The cell shown in a cell sized image.  Images seen before are
+        answered from an LRU cache keyed on a digest of their pixels.
+
+        prior lists the cells the image likely shows, most likely first;
+        the first of them that matches is taken without trying the other
+        templates.  verify ignores prior and matches every template."""
+        key = (cell.shape, blake2b(cell.tobytes(), digest_size=16).digest())
+        with self.__cache_lock:
+            cached = self.__cache.get(key)
+            if cached is not None:
+                self.__cache.move_to_end(key)
+                self.cache_hits += 1
+                return cached
+            self.cache_misses += 1
+        found = self._match_cell(cell, () if verify else prior)
+        if self.cache_size > 0:
+            with self.__cache_lock:
+                self.__cache[key] = found
+                if len(self.__cache) > self.cache_size:
+                    self.__cache.popitem(last=False)
+        return found
+
+    @staticmethod
+    def __stack_templates(named, template0):
+        """Templates shaped like template0, stacked and mean centred per
+        channel for identify_board, with their names and norms."""
+        named = [(n, i) for n, i in named if i.shape == template0.shape]
+        stack = np.stack([i for _, i in named]).astype(np.float32)
+        stack -= stack.mean(axis=(1, 2), keepdims=True)
+        norms = np.sqrt((stack ** 2).sum(axis=(1, 2, 3)))
+        zero = template0.astype(np.float32)
+        return [n for n, _ in named], stack, norms, zero
+
+    def identify_board(self, image: Image, board: "Board") -> np.ndarray:
+        """The cells of a board image as a (rows, cols) array of Cell, scored
+        against all the templates at once through a strided view of the
+        image.  It matches like identify_cell on cells cropped to template
+        size; cells that match no template or several are None."""
+        names, stack, norms, zero = self.__stack
+        found = np.full((board.rows, board.cols), None, dtype=object)
+        ys, xs = board.cell_dims(0, 0)
+        h, w = ys.stop, xs.stop
+        th, tw = zero.shape[:2]
+        if not (h > th and w > tw and h / w == th / tw):
+            return found
+        if image.ndim != 3 or image.shape[2] != zero.shape[2]:
+            return found
+        rows = min(board.rows, image.shape[0] // h)
+        cols = min(board.cols, image.shape[1] // w)
+        y0, x0 = ceil((h - th) / 2), ceil((w - tw) / 2)
+        s0, s1, s2 = image.strides
+        cells = np.lib.stride_tricks.as_strided(
+            image[y0:, x0:],
+            shape=(rows, cols, th, tw, image.shape[2]),
+            strides=(h * s0, w * s1, s0, s1, s2),
+            writeable=False,
+        ).astype(np.float32)
+        # counted as one match per template, as if over the whole image
+        with self.__matches_lock:
+            self.matches += len(names) + 1
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # TM_CCOEFF_NORMED for the templates, TM_CCORR_NORMED for 0
+            centred = cells - cells.mean(axis=(2, 3), keepdims=True)
+            cnorms = np.sqrt((centred ** 2).sum(axis=(2, 3, 4)))
+            scores = np.einsum("rcyxk,tyxk->rct", centred, stack)
+            scores /= cnorms[..., None] * norms
+            score0 = np.einsum("rcyxk,yxk->rc", cells, zero)
+            score0 /= np.sqrt((cells ** 2).sum(axis=(2, 3, 4)))
+            score0 /= np.sqrt((zero ** 2).sum())
+
+        hits = scores >= 0.99
+        counts = hits.sum(axis=2)
+        best = scores.argmax(axis=2)
+        cell_of = np.array(
+            [self.__image_cells[n] for n in names] + [Cell.C0], dtype=object
+        )
+        pick = np.where(counts == 1, best, len(names))
+        sure = (counts == 1) | ((counts == 0) & (score0 >= 0.99))
+        found[:rows, :cols] = np.where(sure, cell_of[pick], None)
+        return found
+
+    def _match_cell(self, cell: Image, prior: Sequence[Cell] = ()) -> Cell:
+        """identify_cell without the cache, trying the prior cells and then
+        every template."""
         saved_cells = self.__cell_images
 
         def matches(cell, saved_cell, name, algo=cv2.TM_CCOEFF_NORMED):
@@ -170,6 +385,21 @@ class FindImage:
                     algo)
                 return name
             return self.get_matches(cell, saved_cell, name, 0.95, algo)
+        templates = dict(saved_cells)
+        templates["0"] = self.__all_images["0"]
+        names = [self.__cell_names.get(c) for c in prior]
+        names = [n for n in names if n in templates]
+        if "0" in names and "UNOPENED" not in names[:names.index("0")]:
+            # 0 is matched loosely enough to pass for UNOPENED
+            names.insert(names.index("0"), "UNOPENED")
+        for name in dict.fromkeys(names):
+            algo = cv2.TM_CCORR_NORMED if name == "0" else cv2.TM_CCOEFF_NORMED
+            try:
+                return self.__image_cells[
+                    matches(cell, templates[name], name, algo)
+                ]
+            except SubImageNotFoundError:
+                pass
         match_vals = []
         for name, img in saved_cells:
             try:
@@ -194,7 +424,7 @@ class FindImage:
 
 
 class FindImageMacnative(FindImage):
-    def __init__(self):
+    def __init__(self, cache_size: int = 1024):
         super().__init__(
             images={
                 name: image_read(f"games/macnative-ms/{filename}")
@@ -202,11 +432,15 @@ class FindImageMacnative(FindImage):
             },
             height=30, width=30,
             extra_x=11, extra_y=11,
+            cache_size=cache_size,
         )
 
 
 class FindImageMinesweeperOnline(FindImage):
-    def __init__(self):
+    STATUS_ABOVE = 41
+    STATUS_SIZE = 32
+
+    def __init__(self, cache_size: int = 1024):
         super().__init__(
             images={
                 name: image_read(f"games/minesweeper.online/{filename}")
@@ -214,6 +448,7 @@ class FindImageMinesweeperOnline(FindImage):
             },
             height=24, width=24,
             extra_x=4, extra_y=4,
+            cache_size=cache_size,
         )
 
 
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+"""Ring buffer of screen frames in a memory mapped file, shared by the
+capture server and play.py on the same host.
+
+Layout, little endian:
+
+    header, 64 bytes: magic b"MSFB", version u32, slots u32,
+                      capacity u32 (pixel bytes per slot), seq u64
+    slots * (slot header, 32 bytes + capacity bytes of pixels)
+    slot header:      seq u64, width u32, height u32, stride u32,
+                      channels u32
+
+Frame seq (counting from 1) lives in slot seq % slots.  The writer
+clears the slot seq, writes the pixels and geometry, then sets the slot
+seq and the header seq.  Pixels are BGRA rows as in the raw screencap.
+
+Stand-in capture server for machines without a display:
+
+    ./framebuffer.py PATH IMAGE [port]
+
+serves /screencap?format=shm from IMAGE through the ring at PATH.
+"""
+
+from http.server import (
+    BaseHTTPRequestHandler,
+    HTTPServer,
+)
+import mmap
+import os
+from typing import (
+    Tuple,
+)
+from urllib.parse import (
+    parse_qs,
+    urlsplit,
+)
+
+import numpy as np
+
+Image = np.ndarray
+
+MAGIC = b"MSFB"
+VERSION = 1
+HEADER = 64
+SLOT_HEADER = 32
+
+
+class StaleFrameError(Exception):
+    "The frame has been overwritten or was never written."
+
+
+class FrameBuffer:
+    def __init__(self, path: str, slots: int = 0, capacity: int = 0):
+        """Opens the ring at path, or creates it when slots and capacity
+        are given."""
+        if slots:
+            size = HEADER + slots * (SLOT_HEADER + capacity)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            os.ftruncate(fd, size)
+        else:
+            fd = os.open(path, os.O_RDWR)
+        try:
+            self.__map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        header = np.frombuffer(self.__map, np.uint32, 4)
+        if slots:
+            self.__map[:4] = MAGIC
+            header[1:] = VERSION, slots, capacity
+            self.__seq[...] = 0
+        elif self.__map[:4] != MAGIC or header[1] != VERSION:
+            raise ValueError(f"{path} is not a frame buffer")
+        self.slots, self.capacity = int(header[2]), int(header[3])
+
+    @property
+    def __seq(self) -> np.ndarray:
+        return np.frombuffer(self.__map, np.uint64, 1, 16)
+
+    @property
+    def seq(self) -> int:
+        "Sequence number of the latest frame, 0 before the first."
+        return int(self.__seq[0])
+
+    def __slot(self, seq: int) -> Tuple[np.ndarray, int]:
+        "The slot header of frame seq and the offset of its pixels."
+        base = HEADER + (seq % self.slots) * (SLOT_HEADER + self.capacity)
+        return np.frombuffer(self.__map, np.uint32, 6, base), base + SLOT_HEADER
+
+    def write(self, image: Image) -> int:
+        "Writes a BGR or BGRA image as the next frame, returns its seq."
+        h, w = image.shape[:2]
+        if w * h * 4 > self.capacity:
+            raise ValueError(f"{w}x{h} frame does not fit in {self.capacity}")
+        seq = self.seq + 1
+        slot, offset = self.__slot(seq)
+        slot[:2].view(np.uint64)[0] = 0
+        pixels = np.frombuffer(self.__map, np.uint8, h * w * 4, offset)
+        pixels = pixels.reshape(h, w, 4)
+        pixels[:, :, :3] = image[:, :, :3]
+        pixels[:, :, 3] = 255
+        slot[2:] = w, h, w * 4, 4
+        slot[:2].view(np.uint64)[0] = seq
+        self.__seq[0] = seq
+        return seq
+
+    def frame(self, seq: int) -> Image:
+        """BGR view of frame seq, without copying.  The view is valid until
+        slots more frames are written."""
+        slot, offset = self.__slot(seq)
+        if seq <= 0 or int(slot[:2].view(np.uint64)[0]) != seq:
+            raise StaleFrameError(seq)
+        w, h, stride, channels = (int(v) for v in slot[2:])
+        rows = np.frombuffer(self.__map, np.uint8, h * stride, offset)
+        rows = rows.reshape(h, stride)[:, :w * channels]
+        return rows.reshape(h, w, channels)[:, :, :3]
+
+    def latest(self) -> Tuple[int, Image]:
+        "The latest frame and its seq."
+        seq = self.seq
+        return seq, self.frame(seq)
+
+
+def serve(path: str, image: Image, port: int = 8888) -> None:
+    "Stands in for the capture server, serving image through the ring."
+    frames = FrameBuffer(path, slots=3, capacity=image.size // 3 * 4)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            params = {k: int(v[0]) for k, v in parse_qs(url.query).items()
+                      if k in ("x", "y", "w", "h")}
+            crop = image
+            if len(params) == 4:
+                x, y, w, h = (params[k] for k in "xywh")
+                if x >= 0 and y >= 0 and w > 0 and h > 0:
+                    crop = image[y:y + h, x:x + w]
+            seq = frames.write(crop)
+            self.send_response(200)
+            self.send_header("X-Sequence", str(seq))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    HTTPServer(("localhost", port), Handler).serve_forever()
+
+
+if __name__ == "__main__":
+    import sys
+
+    import cv2
+
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 8888
+    serve(sys.argv[1], cv2.imread(sys.argv[2]), port)
@@ -1,51 +1,127 @@
 # -*- mode: python; -*-
 
+from collections import (
+    Counter,
+    deque,
+)
+from concurrent.futures import (
+    ProcessPoolExecutor,
+)
 from enum import (
     Enum,
 )
+from functools import (
+    lru_cache,
+)
 from itertools import (
     cycle,
 )
+from math import (
+    comb,
+)
 import random
 from typing import (
     Callable,
     Dict,
+    FrozenSet,
     Generic,
     Iterable,
     Iterator,
     List,
     Optional,
+    Set,
     Tuple,
     TypeVar,
     Union,
 )
+import numpy as np
 import z3
 
 
 Point = Tuple[int, int]
+# unknown cells around a number and the mines still hidden among them
+Constraint = Tuple[Tuple[Point, ...], int]
 T = TypeVar("T")
 K = TypeVar("K")
 V = TypeVar("V")
 
 
+@lru_cache(maxsize=None)
+def neighbor_table(m: int, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """CSR style neighbour index of an m x n board.  The neighbours of the
+    cell at flat index k = i * n + j are indices[indptr[k]:indptr[k + 1]],
+    in row major order.  Built once per board size and shared by every
+    Board of that size."""
+    flat = np.full((m + 2, n + 2), -1, dtype=np.int64)
+    flat[1:-1, 1:-1] = np.arange(m * n).reshape(m, n)
+    nbrs = np.stack(
+        [
+            flat[1 + xi:1 + xi + m, 1 + yj:1 + yj + n]
+            for xi in (-1, 0, +1)
+            for yj in (-1, 0, +1)
+            if (xi, yj) != (0, 0)
+        ],
+        axis=-1,
+    ).reshape(m * n, 8)
+    valid = nbrs >= 0
+    indptr = np.zeros(m * n + 1, dtype=np.int64)
+    np.cumsum(valid.sum(axis=1), out=indptr[1:])
+    indices = nbrs[valid].astype(np.int32 if m * n < 2**31 else np.int64)
+    indptr.flags.writeable = indices.flags.writeable = False
+    return indptr, indices
+
+
+def neighbor_counts(mines: np.ndarray) -> np.ndarray:
+    """Number of mines around every cell, not counting the cell itself: a
+    3 x 3 convolution over the last two axes, so a stack of boards works
+    too."""
+    m, n = mines.shape[-2:]
+    padded = np.zeros(mines.shape[:-2] + (m + 2, n + 2), dtype=np.int8)
+    padded[..., 1:-1, 1:-1] = mines
+    counts = np.zeros(mines.shape, dtype=np.int8)
+    for xi in (0, 1, 2):
+        for yj in (0, 1, 2):
+            if (xi, yj) != (1, 1):
+                counts += padded[..., xi:xi + m, yj:yj + n]
+    return counts
+
+
 class Board(Generic[T]):
     def __init__(
         self,
         m: int,
         n: int,
         supplier: Optional[Union[Callable[[], T], Iterable[T], T]] = None,
+        dtype=None,
     ):
-        if isinstance(supplier, Iterable):
-            repeat = iter(cycle(supplier))
-            supplier = lambda: next(repeat)
-        elif not (callable(supplier)):
-            temp: List[T] = [supplier]
-            supplier = lambda: temp[0]
+        """Cells are kept in an m x n NumPy array.  dtype is inferred from
+        the first value unless given; values that are not bools or ints
+        are stored as objects."""
         self.__m = m
         self.__n = n
-        self.__grid: Dict[Point, T] = {
-            (i, j): supplier() for i in range(m) for j in range(n)
-        }
+        if isinstance(supplier, Iterable) or callable(supplier):
+            if isinstance(supplier, Iterable):
+                repeat = iter(cycle(supplier))
+                supplier = lambda: next(repeat)
+            values = [supplier() for _ in range(m * n)]
+            first = values[0] if values else None
+            self.__grid = np.array(
+                values, dtype=dtype or Board._dtype(first)
+            ).reshape(m, n)
+        else:
+            self.__grid = np.full(
+                (m, n), supplier, dtype=dtype or Board._dtype(supplier)
+            )
+        self.__cells = self.__grid.reshape(-1)  # flat view of the grid
+        self.__indptr, self.__indices = neighbor_table(m, n)
+
+    @staticmethod
+    def _dtype(value):
+        if isinstance(value, (bool, np.bool_)):
+            return np.bool_
+        if isinstance(value, (int, np.integer)):
+            return np.int64
+        return object
 
     @property
     def m(self):
@@ -55,33 +131,52 @@ class Board(Generic[T]):
     def n(self):
         return self.__n
 
+    @property
+    def array(self) -> np.ndarray:
+        "The m x n array backing the board.  Writes go to the board."
+        return self.__grid
+
+    @property
+    def neighbor_table(self) -> Tuple[np.ndarray, np.ndarray]:
+        "indptr, indices of the shared neighbour index, see neighbor_table."
+        return self.__indptr, self.__indices
+
+    def __index(self, p: Point) -> int:
+        i, j = p
+        if 0 <= i < self.__m and 0 <= j < self.__n:
+            return i * self.__n + j
+        raise KeyError(p)
+
     def __setitem__(self, p: Point, val: T) -> None:
-        self[p]  # throw KeyError if missing
-        self.__grid[p] = val
+        self.__cells[self.__index(p)] = val
 
     def __getitem__(self, p: Point) -> T:
-        return self.__grid[p]
+        i, j = p
+        if 0 <= i < self.__m and 0 <= j < self.__n:
+            return self.__cells.item(i * self.__n + j)
+        raise KeyError(p)
 
     def neighbor_xys(self, xy: Point) -> List[Point]:
-        x, y = xy
-        nbrs: List[Point] = [
-            (rx, ry)
-            for xi in (-1, 0, +1)
-            for yj in (-1, 0, +1)
-            if (xi, yj) != (0, 0)
-            and (rx := x + xi, ry := y + yj) in self.__grid
+        k = self.__index(xy)
+        n = self.__n
+        return [
+            divmod(nk, n)
+            for nk in self.__indices[
+                self.__indptr[k]:self.__indptr[k + 1]
+            ].tolist()
         ]
-        return nbrs
 
     def __str__(self) -> str:
         return "\n".join(
-            "".join("O#"[1 if self[i, j] else 0] for j in range(self.n))
-            for i in range(self.m)
+            "".join("O#"[1 if v else 0] for v in row)
+            for row in self.__grid.tolist()
         )
 
     def __iter__(self) -> Iterator[Tuple[Point, T]]:
         return (
-            ((i, j), self[i, j]) for i in range(self.m) for j in range(self.n)
+            ((i, j), v)
+            for i, row in enumerate(self.__grid.tolist())
+            for j, v in enumerate(row)
         )
 
 
@@ -103,21 +198,27 @@ class Minesweeper:
     ):
         self.__m = m
         self.__n = n
-        self.__grid: Board[int] = Board(m, n, lambda: Minesweeper.UNOPENED)
+        self.__grid: Board[int] = Board(
+            m, n, Minesweeper.UNOPENED, dtype=np.int8
+        )
 
         the_mines: Board[bool]
         if isinstance(minecount, int) and minecount > 0:
-            positions: List[Point] = random.sample(
-                [(i, j) for i in range(m) for j in range(n)], k=minecount
-            )
-            the_mines = Board(m, n, lambda: False)
-            for xy in positions:
-                the_mines[xy] = True
+            positions: List[int] = random.sample(range(m * n), k=minecount)
+            the_mines = Board(m, n, False)
+            the_mines.array.reshape(-1)[positions] = True
         else:
-            the_mines = Board(m, n, mines)
+            the_mines = Board(m, n, mines, dtype=np.bool_)
         self.__mines: Board[bool] = the_mines
+        self.__minecount = int(the_mines.array.sum())
+        self.__counts: np.ndarray = neighbor_counts(the_mines.array)
         self.__exploded = False
 
+    @property
+    def minecount(self) -> Optional[int]:
+        "Total number of mines on the board, None if not known."
+        return self.__minecount
+
     @property
     def m(self): return self.__m
 
@@ -160,13 +261,29 @@ class Minesweeper:
             # Explodes if the cell is a mine.
             if self.__exploded:
                 raise ValueError("Exploded")
+            if self[xy] != Minesweeper.UNOPENED:
+                return
             if self.__mines[xy] is True:
                 raise self._explode(xy)
-            if self[xy] == Minesweeper.FLAG:
-                pass
-            self._open(xy)
+            self._reveal(xy)
         elif action == Action.CHORD:
-            raise NotImplementedError("CHORD not yet implemented")
+            # Opens the unflagged neighbours of the number at (x, y) once
+            # as many flags as the number surround it.  Explodes if one of
+            # them is a mine.
+            if self.__exploded:
+                raise ValueError("Exploded")
+            if not (0 <= self[xy] <= 8):
+                return
+            nbrs = self.neighbor_xys(xy)
+            flags = sum(1 for nxy in nbrs if self[nxy] == Minesweeper.FLAG)
+            if flags != self[xy]:
+                return
+            for nxy in nbrs:
+                if self[nxy] != Minesweeper.UNOPENED:
+                    continue
+                if self.__mines[nxy] is True:
+                    raise self._explode(nxy)
+                self._reveal(nxy)
         elif action == Action.MARK:
             self[xy] = Minesweeper.FLAG
         elif action == Action.UNMARK:
@@ -174,70 +291,768 @@ class Minesweeper:
         else:
             raise ValueError(f"Unknown action {action}")
 
+    def click_all(self, moves: Iterable[Tuple[Point, Action]]) -> None:
+        "Applies each (point, action) of moves in turn."
+        for xy, action in moves:
+            self.click(xy, action)
+
     def _open(self, xy: Point) -> List[Tuple[Point, int]]:
         "Same as open but does not explode."
-        if self.__mines[xy] is True:
-            return []
-        if self[xy] != Minesweeper.UNOPENED:
-            return []
-        self[xy] = self._minecount(xy)
-        if self[xy] > 0:
-            return [((xy), self[xy])]
-        # when minecount is 0 open neighbors
-        pt_count_pairs = [((xy), self[xy])]
-        for nij in self.neighbor_xys(xy):
-            pt_count_pairs.extend(self._open(nij))
-        return pt_count_pairs
+        cells = self._reveal(xy)
+        xs, ys = np.divmod(cells, self.n)
+        values = self.__counts.reshape(-1)[cells]
+        return list(zip(zip(xs.tolist(), ys.tolist()), values.tolist()))
+
+    def _reveal(self, xy: Point) -> np.ndarray:
+        """Opens xy unless it is a mine or not unopened, and returns the
+        flat indices of the opened cells.  A cell with no mines around it
+        opens its neighbours, breadth first over the neighbour table."""
+        if self.__mines[xy] is True or self[xy] != Minesweeper.UNOPENED:
+            return np.zeros(0, dtype=np.int64)
+        grid = self.__grid.array.reshape(-1)
+        counts = self.__counts.reshape(-1)
+        indptr, indices = self.__grid.neighbor_table
+        k = xy[0] * self.n + xy[1]
+        grid[k] = counts[k]
+        opened = [np.array([k])]
+        frontier = opened[0] if counts[k] == 0 else opened[0][:0]
+        while frontier.size:
+            # neighbours of every cell in the frontier, gathered from CSR
+            starts = indptr[frontier]
+            lens = indptr[frontier + 1] - starts
+            offsets = np.repeat(starts - np.cumsum(lens) + lens, lens)
+            nbrs = np.unique(indices[offsets + np.arange(lens.sum())])
+            # a 0 has no mine neighbours; flags and open cells stay as is
+            nbrs = nbrs[grid[nbrs] == Minesweeper.UNOPENED]
+            grid[nbrs] = counts[nbrs]
+            opened.append(nbrs)
+            frontier = nbrs[counts[nbrs] == 0]
+        return np.concatenate(opened)
 
     def _explode(self, xy: Point):
-        for i in range(self.m):
-            for j in range(self.n):
-                is_mine_ij = self.__mines[i, j] is True
-                self[i, j] = True if is_mine_ij else self._minecount((i, j))
+        self.__grid.array[:] = np.where(
+            self.__mines.array, Minesweeper.MINE, self.__counts
+        )
         self[xy] = Minesweeper.EXPLODED
         return ValueError(f"Exploded at ({xy})")
 
     def _minecount(self, xy: Point) -> int:
         "mines in the region surrounding (x, y).  Does not count (x, y)."
-        mines = [1 for ij in self.neighbor_xys(xy) if self.__mines[ij]]
-        return sum(mines)
+        return int(self.__counts[xy])
 
     def get_state(self, points: List[Point] = None) -> List[Tuple[Point, int]]:
-        return [
-            ((i, j), self[i, j])
-            for i in range(self.m) for j in range(self.n)
-            if self[i, j] != Minesweeper.UNOPENED
+        """Opened cells and their values: all of them, or only those among
+        points when given."""
+        return opened_cells(self.__grid.array, points)
+
+
+def opened_cells(
+    grid: np.ndarray, points: Optional[List[Point]] = None
+) -> List[Tuple[Point, int]]:
+    "Cells of grid that are not UNOPENED, optionally only among points."
+    if points is None:
+        xys = np.argwhere(grid != Minesweeper.UNOPENED)
+    else:
+        xys = np.array(points, dtype=np.int64).reshape(-1, 2)
+        xys = xys[grid[xys[:, 0], xys[:, 1]] != Minesweeper.UNOPENED]
+    values = grid[xys[:, 0], xys[:, 1]]
+    return list(zip(map(tuple, xys.tolist()), values.tolist()))
+
+
+def _dilate(cells: np.ndarray) -> np.ndarray:
+    "cells and their neighbours, over the last two axes."
+    m, n = cells.shape[-2:]
+    padded = np.zeros(cells.shape[:-2] + (m + 2, n + 2), dtype=np.bool_)
+    padded[..., 1:-1, 1:-1] = cells
+    out = np.zeros(cells.shape, dtype=np.bool_)
+    for xi in (0, 1, 2):
+        for yj in (0, 1, 2):
+            out |= padded[..., xi:xi + m, yj:yj + n]
+    return out
+
+
+class BatchMinesweeper:
+    """Many m x n games stepped together.  The mines, the neighbour counts
+    and what each game shows are stacked in arrays of shape (games, m, n),
+    and click() applies one action per game in a single call, with the
+    same rules as Minesweeper.click.  An exploded game ignores further
+    clicks instead of raising."""
+
+    def __init__(
+        self,
+        games: int,
+        m: int,
+        n: int,
+        *,
+        minecount: int = 0,
+        mines: Optional[np.ndarray] = None,
+        seed: Optional[int] = None,
+    ):
+        """Either place minecount mines at random in every game, using
+        seed, or pass the (games, m, n) mines array."""
+        self.games, self.m, self.n = games, m, n
+        if mines is None:
+            rng = np.random.default_rng(seed)
+            order = rng.random((games, m * n)).argsort(axis=1)
+            mines = np.zeros((games, m * n), dtype=np.bool_)
+            np.put_along_axis(mines, order[:, :minecount], True, axis=1)
+        self.mines: np.ndarray = np.asarray(mines, dtype=np.bool_).reshape(
+            games, m, n
+        )
+        self.counts: np.ndarray = neighbor_counts(self.mines)
+        self.grid: np.ndarray = np.full(
+            (games, m, n), Minesweeper.UNOPENED, dtype=np.int8
+        )
+        self.exploded: np.ndarray = np.zeros(games, dtype=np.bool_)
+
+    @property
+    def minecounts(self) -> np.ndarray:
+        return self.mines.sum(axis=(1, 2))
+
+    def game(self, g: int) -> "BatchGame":
+        "Game g seen as a single board, e.g. for a MineSolver."
+        return BatchGame(self, g)
+
+    def click(
+        self,
+        xys: np.ndarray,
+        actions: Union[Action, Iterable[Action]],
+    ) -> np.ndarray:
+        """Applies actions[g] at xys[g] in every game g.  A point with a
+        negative coordinate skips that game.  Returns a (games, m, n)
+        mask of the cells opened by this call."""
+        xys = np.asarray(xys, dtype=np.int64).reshape(self.games, 2)
+        if isinstance(actions, Action):
+            actions = [actions] * self.games
+        codes = np.array([a.value for a in actions])
+        active = (xys >= 0).all(axis=1) & ~self.exploded
+        gs = np.nonzero(active)[0]
+        xs, ys = xys[gs, 0], xys[gs, 1]
+        codes = codes[gs]
+
+        for code, value in (
+            (Action.MARK.value, Minesweeper.FLAG),
+            (Action.UNMARK.value, Minesweeper.UNOPENED),
+        ):
+            sel = codes == code
+            self.grid[gs[sel], xs[sel], ys[sel]] = value
+
+        opening = np.zeros(self.grid.shape, dtype=np.bool_)
+        sel = codes == Action.OPEN.value
+        opening[gs[sel], xs[sel], ys[sel]] = True
+
+        sel = codes == Action.CHORD.value
+        cgs, cxs, cys = gs[sel], xs[sel], ys[sel]
+        values = self.grid[cgs, cxs, cys]
+        flags = np.zeros(len(cgs), dtype=np.int64)
+        around = []
+        for xi in (-1, 0, +1):
+            for yj in (-1, 0, +1):
+                if (xi, yj) == (0, 0):
+                    continue
+                nxs, nys = cxs + xi, cys + yj
+                inside = (
+                    (0 <= nxs) & (nxs < self.m) & (0 <= nys) & (nys < self.n)
+                )
+                nxs, nys = np.where(inside, nxs, 0), np.where(inside, nys, 0)
+                state = self.grid[cgs, nxs, nys]
+                flags += inside & (state == Minesweeper.FLAG)
+                around.append(
+                    (inside & (state == Minesweeper.UNOPENED), nxs, nys)
+                )
+        chords = (values <= 8) & (flags == values)
+        for unopened, nxs, nys in around:
+            sel = chords & unopened
+            opening[cgs[sel], nxs[sel], nys[sel]] = True
+
+        # opening a mine explodes the game, like Minesweeper._explode
+        opening &= self.grid == Minesweeper.UNOPENED
+        blown = opening & self.mines
+        for g in np.nonzero(blown.any(axis=(1, 2)))[0]:
+            self.grid[g] = np.where(
+                self.mines[g], Minesweeper.MINE, self.counts[g]
+            )
+            x, y = np.argwhere(blown[g])[0]
+            self.grid[g, x, y] = Minesweeper.EXPLODED
+            self.exploded[g] = True
+            opening[g] = False
+
+        # open 0 regions breadth first, all games at once
+        revealed = opening.copy()
+        zeros = self.counts == 0
+        frontier = revealed & zeros
+        while frontier.any():
+            added = (
+                _dilate(frontier)
+                & (self.grid == Minesweeper.UNOPENED)
+                & ~revealed
+            )
+            revealed |= added
+            frontier = added & zeros
+        self.grid[revealed] = self.counts[revealed]
+        return revealed
+
+
+class BatchGame:
+    "One game of a BatchMinesweeper, with the board interface MineSolver uses."
+
+    def __init__(self, batch: BatchMinesweeper, g: int):
+        self.batch, self.g = batch, g
+        self.m, self.n = batch.m, batch.n
+
+    @property
+    def minecount(self) -> Optional[int]:
+        return int(self.batch.mines[self.g].sum())
+
+    def __getitem__(self, v: Point) -> int:
+        return int(self.batch.grid[self.g][v])
+
+    def get_state(self, points: List[Point] = None) -> List[Tuple[Point, int]]:
+        return opened_cells(self.batch.grid[self.g], points)
+
+
+def deduce(constraints: List[Constraint]) -> Tuple[List[Point], List[Point]]:
+    """Settles cells with simple rules, repeated until nothing changes:
+
+    - a number with no mines left has only safe unknowns around it,
+    - a number with as many mines left as unknowns has only mines,
+    - for two overlapping numbers A and B, if A needs as many more mines
+      than B as it has cells outside B, those cells are all mines and
+      B's cells outside A are all safe.  This covers the subset rule.
+
+    Returns the cells found to be mines and the cells found to be safe.
+    """
+    mines: Set[Point] = set()
+    safes: Set[Point] = set()
+    work = [(frozenset(unknowns), count) for unknowns, count in constraints]
+    changed = True
+    while changed:
+        changed = False
+        simplified = set()
+        for cells, count in work:
+            count -= len(cells & mines)
+            cells = cells - mines - safes
+            if count < 0 or count > len(cells):
+                raise ValueError("solver in unsat state")
+            if cells:
+                simplified.add((cells, count))
+        work = list(simplified)
+
+        for cells, count in work:
+            if count == 0:
+                safes |= cells
+                changed = True
+            elif count == len(cells):
+                mines |= cells
+                changed = True
+        if changed:
+            continue
+
+        by_cell: Dict[Point, List[Tuple[FrozenSet[Point], int]]] = {}
+        for constraint in work:
+            for pt in constraint[0]:
+                by_cell.setdefault(pt, []).append(constraint)
+        for acells, acount in work:
+            overlapping = {c for pt in acells for c in by_cell[pt]}
+            for bcells, bcount in overlapping:
+                only_a = acells - bcells
+                if (only_a or bcells - acells) and (
+                    acount - bcount == len(only_a)
+                ):
+                    mines |= only_a
+                    safes |= bcells - acells
+                    changed = True
+    return sorted(mines), sorted(safes)
+
+
+def frontier_components(
+    constraints: List[Constraint],
+) -> List[List[Constraint]]:
+    "Splits constraints into groups that share no unknown cell."
+    parent: Dict[Point, Point] = {}
+
+    def find(p: Point) -> Point:
+        while parent[p] != p:
+            parent[p] = parent[parent[p]]
+            p = parent[p]
+        return p
+
+    for unknowns, _ in constraints:
+        for p in unknowns:
+            parent.setdefault(p, p)
+        root = find(unknowns[0])
+        for p in unknowns[1:]:
+            parent[find(p)] = root
+
+    groups: Dict[Point, List[Constraint]] = {}
+    for constraint in constraints:
+        groups.setdefault(find(constraint[0][0]), []).append(constraint)
+    return list(groups.values())
+
+
+def forced_cells(
+    cells: Dict[Point, z3.Int], solver: z3.Solver, models: int = 3
+) -> Tuple[List[Point], List[Point]]:
+    """Cells that are a mine in every model and cells that are never one.
+
+    Instead of asking z3 about both values of every cell, keep each cell's
+    value in the current model as a candidate.  A few more models, each
+    required to differ from the candidates somewhere, drop the cells that
+    change.  Only the survivors are confirmed, with one query each, and a
+    model returned by a failed confirmation prunes the rest too.  The last
+    call to solver.check() must have returned sat.
+    """
+    def value(model: z3.ModelRef, cell: z3.Int) -> int:
+        return model.eval(cell, model_completion=True).as_long()
+
+    model = solver.model()
+    candidates = {pt: value(model, cell) for pt, cell in cells.items()}
+
+    def prune(model: z3.ModelRef) -> None:
+        for pt, v in list(candidates.items()):
+            if value(model, cells[pt]) != v:
+                del candidates[pt]
+
+    confirmed = False
+    for _ in range(models):
+        if not candidates:
+            break
+        differs = z3.Or([cells[pt] != v for pt, v in candidates.items()])
+        if solver.check(differs) == z3.unsat:
+            confirmed = True
+            break
+        prune(solver.model())
+
+    mines: List[Point] = []
+    nonmines: List[Point] = []
+    for pt, cell in cells.items():
+        if pt not in candidates:
+            continue
+        v = candidates.pop(pt)
+        if confirmed or solver.check(cell != v) == z3.unsat:
+            (mines if v else nonmines).append(pt)
+        else:
+            prune(solver.model())
+    return mines, nonmines
+
+
+def solve_component(
+    constraints: List[Constraint],
+) -> Tuple[List[Point], List[Point]]:
+    """Solves one frontier component in a z3 problem of its own.  Takes and
+    returns plain data so it can run in a worker process."""
+    solver: z3.Solver = z3.Solver()
+    cells: Dict[Point, z3.Int] = dict()
+    for unknowns, count in constraints:
+        for pt in unknowns:
+            if pt not in cells:
+                cells[pt] = z3.Int(f"c{pt}")
+                solver.add(z3.Or(cells[pt] == 0, cells[pt] == 1))
+        solver.add(count == z3.Sum([cells[pt] for pt in unknowns]))
+
+    if solver.check() == z3.unsat:
+        raise ValueError("solver in unsat state")
+
+    return forced_cells(cells, solver)
+
+
+# components with more unknowns than this are not enumerated exactly
+MAX_LAYOUT_CELLS = 40
+
+
+def count_layouts(
+    constraints: List[Constraint],
+) -> Tuple[List[Point], List[int], List[List[int]]]:
+    """Enumerates the mine layouts of one frontier component.
+
+    Returns the component's cells, counts where counts[k] is the number of
+    layouts with k mines, and cellcounts where cellcounts[k][i] is the
+    number of those layouts in which cells[i] is a mine.
+    """
+    # visit cells in breadth first order so constraints close early
+    by_cell: Dict[Point, List[int]] = {}
+    for ci, (unknowns, _) in enumerate(constraints):
+        for pt in unknowns:
+            by_cell.setdefault(pt, []).append(ci)
+    cells: List[Point] = []
+    seen: Set[Point] = set()
+    for start in sorted(by_cell):
+        queue = deque([start]) if start not in seen else deque()
+        seen.add(start)
+        while queue:
+            pt = queue.popleft()
+            cells.append(pt)
+            for ci in by_cell[pt]:
+                for nxt in constraints[ci][0]:
+                    if nxt not in seen:
+                        seen.add(nxt)
+                        queue.append(nxt)
+
+    cons_of = [by_cell[pt] for pt in cells]
+    need = [count for _, count in constraints]
+    left = [len(unknowns) for unknowns, _ in constraints]
+    counts = [0] * (len(cells) + 1)
+    cellcounts = [[0] * len(cells) for _ in range(len(cells) + 1)]
+    chosen: List[int] = []
+
+    def search(i: int) -> None:
+        if i == len(cells):
+            k = len(chosen)
+            counts[k] += 1
+            for j in chosen:
+                cellcounts[k][j] += 1
+            return
+        for v in (0, 1):
+            for ci in cons_of[i]:
+                need[ci] -= v
+                left[ci] -= 1
+            if all(0 <= need[ci] <= left[ci] for ci in cons_of[i]):
+                if v:
+                    chosen.append(i)
+                search(i + 1)
+                if v:
+                    chosen.pop()
+            for ci in cons_of[i]:
+                need[ci] += v
+                left[ci] += 1
+
+    search(0)
+    return cells, counts, cellcounts
+
+
+def _convolve(a: List[int], b: List[int]) -> List[int]:
+    out = [0] * (len(a) + len(b) - 1)
+    for i, x in enumerate(a):
+        if x:
+            for j, y in enumerate(b):
+                out[i + j] += x * y
+    return out
+
+
+def mine_probabilities(
+    constraints: List[Constraint],
+    interior: List[Point],
+    minesleft: Optional[int] = None,
+) -> Dict[Point, float]:
+    """Probability that each unknown cell is a mine, given the frontier
+    constraints, the unknown cells away from the frontier (interior) and
+    the number of mines not yet found.
+
+    Layouts are counted per frontier component.  When minesleft is known
+    every combination of component layouts with f mines in total is
+    weighted by comb(len(interior), minesleft - f), the number of ways
+    to place the rest of the mines in the interior.  Without minesleft
+    the components are taken as independent and the interior cells get
+    the mean frontier probability.
+    """
+    probs: Dict[Point, float] = {}
+    layouts = []
+    approximated = 0  # cells of the components too large to enumerate
+    for component in frontier_components(constraints):
+        unknowns = {pt for cells, _ in component for pt in cells}
+        if len(unknowns) <= MAX_LAYOUT_CELLS:
+            layouts.append(count_layouts(component))
+            continue
+        # too large to enumerate: use the densest constraint on each cell
+        approximated += len(unknowns)
+        for pt in unknowns:
+            probs[pt] = max(
+                count / len(cells) for cells, count in component
+                if pt in cells
+            )
+    approximated_mines = sum(probs.values())
+
+    if minesleft is None:
+        for cells, counts, cellcounts in layouts:
+            total = sum(counts)
+            for i, pt in enumerate(cells):
+                probs[pt] = sum(cc[i] for cc in cellcounts) / total
+        if interior:
+            mean = sum(probs.values()) / len(probs) if probs else 0.5
+            probs.update((pt, mean) for pt in interior)
+        return probs
+
+    # the mines not in the enumerated components are placed among the
+    # interior and the approximated cells alike
+    rest_cells = len(interior) + approximated
+
+    everything = [1]
+    for _, counts, _ in layouts:
+        everything = _convolve(everything, counts)
+    # weight[f] = comb(rest_cells, minesleft - f), each from the one before
+    # as comb(n, r) = comb(n, r + 1) * (r + 1) / (n - r)
+    weight = [0] * len(everything)
+    for f in range(len(everything)):
+        rest = minesleft - f
+        if 0 <= rest <= rest_cells:
+            weight[f] = (
+                weight[f - 1] * (rest + 1) // (rest_cells - rest)
+                if f and weight[f - 1] else comb(rest_cells, rest)
+            )
+    total = sum(w * weight[f] for f, w in enumerate(everything))
+    if total == 0:
+        raise ValueError("no layout fits the mines left")
+
+    for c, (cells, counts, cellcounts) in enumerate(layouts):
+        others = [1]
+        for d, (_, dcounts, _) in enumerate(layouts):
+            if d != c:
+                others = _convolve(others, dcounts)
+        # weight of k mines in this component, summed over the others
+        kweight = [
+            sum(w * weight[k + j] for j, w in enumerate(others))
+            for k in range(len(counts))
         ]
+        for i, pt in enumerate(cells):
+            probs[pt] = sum(
+                cellcounts[k][i] * kweight[k] for k in range(len(counts))
+            ) / total
+    if interior:
+        expected = sum(
+            w * weight[f] * (minesleft - f)
+            for f, w in enumerate(everything)
+        ) / total
+        p_interior = (expected - approximated_mines) / len(interior)
+        p_interior = min(max(p_interior, 0.0), 1.0)
+        probs.update((pt, p_interior) for pt in interior)
+    return probs
 
 
 class MineSolver:
     UNKNOWN = 10
     MINE = 11
 
-    def __init__(self, minesweeper: Minesweeper):
+    def __init__(
+        self,
+        minesweeper: Minesweeper,
+        *,
+        frontier_only=True,
+        workers=0,
+        rules=True,
+        endgame_unknowns=64,
+    ):
+        """Set frontier_only=False to encode every cell on the board for z3
+        instead of only the unknowns that border a number.  Set workers to
+        solve the independent components of the frontier on a process pool
+        of that size.  Set rules=False to skip the rule based pre-pass and
+        always go to z3.  Once no more than endgame_unknowns cells are
+        unknown, the total mine count of the board is added as a
+        constraint over all of them."""
         self.minesweeper = minesweeper
         self.m, self.n = self.minesweeper.m, self.minesweeper.n
-        self.__known: Board[int] = Board(self.m, self.n, MineSolver.UNKNOWN)
+        self.frontier_only = frontier_only
+        self.workers = workers
+        self.rules = rules
+        self.endgame_unknowns = endgame_unknowns
+        # engine that settled the last move and how often each one did
+        self.engine = ""
+        self.engine_counts: Counter = Counter()
+        self.__pool: Optional[ProcessPoolExecutor] = None
+        self.__known: Board[int] = Board(
+            self.m, self.n, MineSolver.UNKNOWN, dtype=np.int8
+        )
+        self.__unknown_count = self.m * self.n
+        self.__mine_count = 0
+        # numbers that still have unknown neighbours
+        self.__frontier: Set[Point] = set()
+        # z3 session kept for the whole game in frontier mode
+        self.__solver: z3.Solver = z3.Solver()
+        self.__cells: Dict[Point, z3.Int] = dict()
+        self.__encoded: Set[Point] = set()  # numbers already in the session
+        self.__settled: Set[Point] = set()  # cells in cells now known
 
     @property
     def known(self): return self.__known
 
     def unknowns(self) -> Iterable[Point]:
-        return (pt for pt, v in self.known if v == MineSolver.UNKNOWN)
+        return map(
+            tuple, np.argwhere(self.known.array == MineSolver.UNKNOWN).tolist()
+        )
 
     def add_known(self, xy: Point, val: int) -> None:
+        old = self.known[xy]
         self.known[xy] = val
+        self.__unknown_count += (
+            (val == MineSolver.UNKNOWN) - (old == MineSolver.UNKNOWN)
+        )
+        self.__mine_count += (val == MineSolver.MINE) - (old == MineSolver.MINE)
+        if xy in self.__cells:
+            self.__settled.add(xy)
+        for pt in [xy] + self.known.neighbor_xys(xy):
+            if self.is_frontier(pt):
+                self.__frontier.add(pt)
+            else:
+                self.__frontier.discard(pt)
 
-    def update_board_state(self, fetch_full_board):
+    def is_frontier(self, xy: Point) -> bool:
+        "True if xy is a number with at least one unknown neighbour."
+        if self.known[xy] in (MineSolver.UNKNOWN, MineSolver.MINE):
+            return False
+        return any(
+            self.known[nxy] == MineSolver.UNKNOWN
+            for nxy in self.known.neighbor_xys(xy)
+        )
+
+    def frontier_constraints(self) -> List[Constraint]:
+        """One constraint per frontier number: its unknown neighbours and
+        the count of mines among them not yet accounted for."""
+        constraints: List[Constraint] = []
+        for pt in sorted(self.__frontier):
+            neighbors = self.known.neighbor_xys(pt)
+            unknowns = tuple(
+                nxy for nxy in neighbors
+                if self.known[nxy] == MineSolver.UNKNOWN
+            )
+            mines = sum(
+                1 for nxy in neighbors if self.known[nxy] == MineSolver.MINE
+            )
+            constraints.append((unknowns, self.known[pt] - mines))
+        return constraints
+
+    def endgame_constraint(self) -> Optional[Constraint]:
+        """All unknown cells with the mines still to be found, once few
+        enough cells are unknown and the board's mine count is known."""
+        minecount = self.minesweeper.minecount
+        if minecount is None or not (
+            0 < self.__unknown_count <= self.endgame_unknowns
+        ):
+            return None
+        return tuple(self.unknowns()), minecount - self.__mine_count
+
+    def update_board_state(
+        self, fetch_full_board, safe: Iterable[Point] = ()
+    ):
         """Get current board state from the minesweeper board.  Set
         fetch_full_board=True to refresh the entire board state.
+
+        safe holds cells already proven safe, e.g. by an earlier solve.
+        Those still unopened are returned too, and z3 is skipped if there
+        are any.
         """
         bstate = self.minesweeper.get_state(
             list(self.unknowns()) if not fetch_full_board else None
         )
         for pxy, mc in bstate:
-            self.add_known(pxy, mc)
+            if mc == Minesweeper.FLAG:  # only sure mines are flagged
+                mc = MineSolver.MINE
+            if self.known[pxy] != mc:
+                self.add_known(pxy, mc)
+
+        non_mines: List[Point] = []
+        if self.rules:
+            constraints = self.frontier_constraints()
+            endgame = self.endgame_constraint()
+            if endgame is not None:
+                constraints.append(endgame)
+            mines, non_mines = deduce(constraints)
+            for minexy in mines:
+                self.add_known(minexy, MineSolver.MINE)
+        self.engine = "rules"
+        found = set(non_mines)
+        non_mines += sorted(
+            pt for pt in set(safe) - found
+            if self.known[pt] == MineSolver.UNKNOWN
+        )
+        if not non_mines:
+            self.engine = "z3"
+            mines, non_mines = self.solve_z3()
+            for minexy in mines:
+                self.add_known(minexy, MineSolver.MINE)
+        self.engine_counts[self.engine] += 1
+
+        return non_mines
+
+    def solve_z3(self) -> Tuple[List[Point], List[Point]]:
+        "Finds the sure mines and safe cells with z3."
+        endgame = self.endgame_constraint()
+        if self.frontier_only and self.workers > 0:
+            return self.solve_components(endgame)
+
+        if self.frontier_only:
+            solver, cells = self.frontier_model()
+            if endgame is not None:
+                for pt in endgame[0]:
+                    cells[pt] = self.__variable(pt)
+        else:
+            solver, cells = self.board_model()
+            if endgame is None:
+                # only cells next to a number can be forced
+                frontier = {
+                    pt for unknowns, _ in self.frontier_constraints()
+                    for pt in unknowns
+                }
+                cells = {pt: c for pt, c in cells.items() if pt in frontier}
+
+        if endgame is not None:
+            unknowns, count = endgame
+            solver.push()
+            solver.add(count == z3.Sum([cells[pt] for pt in unknowns]))
+        try:
+            if solver.check() == z3.unsat:
+                raise ValueError("solver in unsat state")
+
+            return self.sure_mines_nonmines(cells, solver)
+        finally:
+            if endgame is not None:
+                solver.pop()
+
+    def __variable(self, pt: Point) -> z3.Int:
+        "The session variable for pt, created on first use."
+        if pt not in self.__cells:
+            cell = self.__cells[pt] = z3.Int(f"c{pt}")
+            self.__solver.add(z3.Or(cell == 0, cell == 1))
+        return self.__cells[pt]
+
+    def frontier_model(self) -> Tuple[z3.Solver, Dict[Point, z3.Int]]:
+        """Encodes only the unknowns bordering a number and the numbers
+        around them.  Cells away from the frontier are left out of z3.
 
+        The same solver is used for the whole game.  Each call only adds
+        the numbers revealed and the cells settled since the last call, so
+        z3 keeps what it learned on earlier moves."""
+        solver, allcells = self.__solver, self.__cells
+        for pt in self.__settled:
+            solver.add(allcells[pt] == int(self.known[pt] == MineSolver.MINE))
+        self.__settled.clear()
+
+        cells: Dict[Point, z3.Int] = dict()
+        for (unknowns, count), pt in zip(
+            self.frontier_constraints(), sorted(self.__frontier)
+        ):
+            for uxy in unknowns:
+                cells[uxy] = self.__variable(uxy)
+            if pt not in self.__encoded:
+                self.__encoded.add(pt)
+                solver.add(count == z3.Sum([allcells[u] for u in unknowns]))
+        return solver, cells
+
+    def solve_components(
+        self, endgame: Optional[Constraint] = None
+    ) -> Tuple[List[Point], List[Point]]:
+        """Solves each independent component of the frontier on the process
+        pool and merges the results.  The z3 session is not used.  The
+        endgame constraint joins every unknown into a single component."""
+        if self.__pool is None:
+            self.__pool = ProcessPoolExecutor(max_workers=self.workers)
+        constraints = self.frontier_constraints()
+        if endgame is not None:
+            constraints.append(endgame)
+        components = frontier_components(constraints)
+        mines: List[Point] = []
+        nonmines: List[Point] = []
+        for cmines, cnonmines in self.__pool.map(solve_component, components):
+            mines.extend(cmines)
+            nonmines.extend(cnonmines)
+        return mines, nonmines
+
+    def close(self) -> None:
+        "Shuts down the process pool, if one was started."
+        if self.__pool is not None:
+            self.__pool.shutdown()
+            self.__pool = None
+
+    def board_model(self) -> Tuple[z3.Solver, Dict[Point, z3.Int]]:
+        "Encodes every cell on the board."
         solver: z3.Solver = z3.Solver()
         cells: Dict[Point, z3.Int] = dict()
         for pt, v in self.known:
@@ -254,36 +1069,94 @@ class MineSolver:
                 neighbors = self.known.neighbor_xys(pt)
                 ncells = [cells[nxy] for nxy in neighbors]
                 solver.add(v == sum(ncells))
+        return solver, cells
 
-        if solver.check() == z3.unsat:
-            raise ValueError("solver in unsat state")
-
-        mines, non_mines = self.sure_mines_nonmines(cells, solver)
-        for minexy in mines:
-            self.add_known(minexy, MineSolver.MINE)
-
-        return non_mines
+    def probabilities(
+        self, minecount: Optional[int] = None
+    ) -> List[Tuple[Point, float]]:
+        """Unknown cells with their chance of being a mine, safest first.
+        The total number of mines on the board, by default the board's own
+        minecount, weights layouts by how many ways the remaining mines
+        fit in the interior."""
+        if minecount is None:
+            minecount = self.minesweeper.minecount
+        constraints = self.frontier_constraints()
+        frontier = {pt for cells, _ in constraints for pt in cells}
+        interior = [pt for pt in self.unknowns() if pt not in frontier]
+        minesleft = None
+        if minecount is not None:
+            minesleft = minecount - self.__mine_count
+        probs = mine_probabilities(constraints, interior, minesleft)
+        return sorted(probs.items(), key=lambda pv: pv[1])
 
     def sure_mines_nonmines(
         self, cells: Dict[Point, z3.Int], solver: z3.Solver
     ) -> Tuple[List[Point], List[Point]]:
-        def dwim(pt, condition):
-            if solver.check(condition) == z3.unsat:
-                return pt
-            return None
+        "Sure mines and safe cells among the unknowns in cells."
+        unknowns = {
+            pt: cell for pt, cell in cells.items()
+            if self.known[pt] == MineSolver.UNKNOWN
+        }
+        return forced_cells(unknowns, solver)
+
+
+def plan_moves(
+    solver: MineSolver, rm: Minesweeper, unmines: List[Point]
+) -> Tuple[List[Tuple[Point, Action]], int]:
+    """Clicks that open the cells in unmines, and the clicks saved.
+
+    A number whose mines are all known can open the rest of its
+    neighbours with one chord once those mines are flagged.  The chord is
+    used when it opens more cells than the flags and the chord cost.
+    """
+    known = solver.known
+    todo = set(unmines)
+    flagged = set()
+    moves: List[Tuple[Point, Action]] = []
+    saved = 0
 
-        mines_nonmines: List[Tuple[Optional[Point], Optional[Point]]] = [
-            (dwim(pt, cell == 0), dwim(pt, cell == 1))
-            for pt, cell in cells.items()
+    def chord(number: Point) -> Tuple[List[Point], List[Point]]:
+        "Cells a chord on number would open and the flags it needs."
+        nbrs = known.neighbor_xys(number)
+        mines = [p for p in nbrs if known[p] == MineSolver.MINE]
+        if len(mines) != known[number]:
+            return [], []
+        flags = [
+            p for p in mines
+            if p not in flagged and rm[p] != Minesweeper.FLAG
         ]
+        return [p for p in nbrs if p in todo], flags
 
-        mines = [v for v, _ in mines_nonmines if v]
-        nonmines = [
-            v
-            for _, v in mines_nonmines
-            if v and self.known[v] == MineSolver.UNKNOWN
+    for point in unmines:
+        if point not in todo:
+            continue
+        numbers = [
+            p for p in known.neighbor_xys(point)
+            if 0 <= known[p] <= 8
         ]
+        best = max(
+            (chord(p) + (p,) for p in numbers),
+            key=lambda ofp: len(ofp[0]) - len(ofp[1]),
+            default=([], [], None),
+        )
+        opens, flags, number = best
+        if len(opens) > len(flags) + 1:
+            moves.extend((p, Action.MARK) for p in flags)
+            moves.append((number, Action.CHORD))
+            flagged.update(flags)
+            todo.difference_update(opens)
+            saved += len(opens) - len(flags) - 1
+        else:
+            moves.append((point, Action.OPEN))
+            todo.discard(point)
+    return moves, saved
 
-        return mines, nonmines
+
+def guess(solver: MineSolver, selector) -> Tuple[Point, float]:
+    """Cell to open when none is known to be safe, picked by selector among
+    the cells least likely to be a mine, and that likelihood."""
+    ranked = solver.probabilities()
+    safest = ranked[0][1]
+    return selector([pt for pt, pr in ranked if pr <= safest]), safest
 
 # minesweeper.py ends here
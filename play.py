@@ -1,9 +1,27 @@
 #!/usr/bin/env python3
 
+from collections import (
+    Counter,
+)
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+)
+from hashlib import (
+    blake2b,
+)
+import json
+import os
+import threading
 import time
 from typing import (
+    Callable,
+    Dict,
     List,
+    Optional,
+    Set,
     Tuple,
+    Union,
 )
 
 from minesweeper import (
@@ -11,6 +29,11 @@ from minesweeper import (
     Minesweeper,
     MineSolver,
     Point,
+    guess,
+    plan_moves,
+)
+from framebuffer import (
+    FrameBuffer,
 )
 from find_minesweeper_grid import (
     Board,
@@ -34,13 +57,27 @@ class Robot:
         p2x, p2y = p2
         return int(((p1x - p2x) ** 2 + (p1y - p2y) ** 2) ** 0.5)
 
-    def __init__(self, port: int):
+    def __init__(
+        self,
+        port: int,
+        image_format: str = "raw",
+        framebuffer: Optional[str] = None,
+    ):
+        """image_format is raw (uncompressed pixels), png, or shm (frames
+        read from the ring buffer file the server writes to framebuffer)."""
         self.__port = port
         self.__url = f"http://localhost:{port}"
+        self.image_format = image_format
+        self.__frames: Optional[FrameBuffer] = None
+        if image_format == "shm":
+            self.__frames = FrameBuffer(framebuffer)
         self.lastpos: Tuple[int, int] = (-1, -1)
         self.total_distance: int = 0
         self.total_clicks = 0
         self.total_bandwidth = 0
+        self.bandwidth: Counter = Counter()  # bytes received per format
+        # one keep-alive connection for all requests
+        self.__session = requests.Session()
 
     def move_to(self, x, y) -> Point:
         rx, ry = -1, -1
@@ -54,12 +91,32 @@ class Robot:
         self.lastpos = rx, ry
         return rx, ry
 
-    def click(self) -> Point:
-        rj = self.__request("mouseclick").json()
+    def click(self, button: str = "left") -> Point:
+        "button is one of left, right, middle or both (chord)."
+        rj = self.__request("mouseclick", {"button": button}).json()
         rx, ry = rj["x"], rj["y"]
         self.total_clicks += 1
         return rx, ry
 
+    def batch(self, ops: List[Tuple]) -> List[Point]:
+        """Runs ("move", x, y) and ("click", button) operations in one
+        request and returns the mouse position after each.  The server
+        stops at a move that misses its target, so fewer positions than
+        ops come back in that case."""
+        encoded = ";".join(",".join(map(str, op)) for op in ops)
+        rj = self.__session.post(
+            self.__url + "/batch", data={"ops": encoded}
+        ).json()
+        positions = [(p["x"], p["y"]) for p in rj]
+        for op, pos in zip(ops, positions):
+            if op[0] == "move":
+                if self.lastpos == (-1, -1): self.lastpos = pos
+                self.total_distance += Robot._distance(self.lastpos, pos)
+                self.lastpos = pos
+            else:
+                self.total_clicks += 1
+        return positions
+
     def screencap(
             self, x: int = None, y: int = None, w: int = None, h: int = None
     ) -> Image:
@@ -67,16 +124,80 @@ class Robot:
             params = {"x": x, "y": y, "w": w, "h": h}
         else:
             params = {}
-        img = self.__request("screencap", params=params).content
+        params["format"] = self.image_format
+        resp = self.__request("screencap", params=params)
+        if self.__frames is not None:
+            # zero copy view, valid until the ring wraps around
+            frame = self.__frames.frame(int(resp.headers["X-Sequence"]))
+            self.total_bandwidth += frame.shape[0] * frame.strides[0]
+            self.bandwidth["shm"] += frame.shape[0] * frame.strides[0]
+            return frame
+        img = resp.content
         self.total_bandwidth += len(img)
+        self.bandwidth[self.image_format] += len(img)
         nparr = np.frombuffer(img, np.uint8)
-        return cv2.imdecode(nparr, cv2.IMREAD_ANYCOLOR)
+        if self.image_format != "raw":
+            return cv2.imdecode(nparr, cv2.IMREAD_ANYCOLOR)
+        # a BGR view of the BGRA rows, no decode or copy
+        headers = resp.headers
+        w, h = int(headers["X-Width"]), int(headers["X-Height"])
+        stride = int(headers["X-Stride"])
+        channels = int(headers["X-Channels"])
+        rows = nparr.reshape(h, stride)[:, :w * channels]
+        return rows.reshape(h, w, channels)[:, :, :3]
 
     def delay(self, millis: int) -> None:
         time.sleep(1e-3 * millis)
 
     def __request(self, path, params={}):
-        return requests.get(self.__url + "/" + path, params=params)
+        return self.__session.get(self.__url + "/" + path, params=params)
+
+
+class AsyncRobot:
+    """A Robot whose calls run one at a time, in order, on a background
+    thread.  submit and the *_async methods return futures; the plain
+    Robot methods wait for theirs.  Calls made on the robot thread itself
+    run at once."""
+
+    def __init__(self, robot: Robot):
+        self.robot = robot
+        self.__thread: Optional[threading.Thread] = None
+        self.__worker = ThreadPoolExecutor(1, initializer=self.__started)
+
+    def __started(self) -> None:
+        self.__thread = threading.current_thread()
+
+    def __getattr__(self, name):
+        # lastpos, total_distance and the other counters
+        return getattr(self.robot, name)
+
+    def submit(self, fn: Callable, *args) -> Future:
+        if threading.current_thread() is self.__thread:
+            future: Future = Future()
+            future.set_result(fn(*args))
+            return future
+        return self.__worker.submit(fn, *args)
+
+    def batch_async(self, ops: List[Tuple]) -> Future:
+        return self.submit(self.robot.batch, ops)
+
+    def screencap_async(self, *args) -> Future:
+        return self.submit(self.robot.screencap, *args)
+
+    def batch(self, ops: List[Tuple]) -> List[Point]:
+        return self.batch_async(ops).result()
+
+    def screencap(self, *args) -> Image:
+        return self.screencap_async(*args).result()
+
+    def move_to(self, x, y) -> Point:
+        return self.submit(self.robot.move_to, x, y).result()
+
+    def click(self, button: str = "left") -> Point:
+        return self.submit(self.robot.click, button).result()
+
+    def close(self) -> None:
+        self.__worker.shutdown()
 
 
 class GameSolvedError(Exception):
@@ -88,12 +209,69 @@ class GameExplodedError(Exception):
 
 
 class RobotMinesweeper(Minesweeper):
-    def __init__(self, robot: Robot, finder: FindImage, board: Board, topleft):
+    # the cells showing a count, for _prior
+    NUMBERS = [
+        Cell.C0, Cell.C1, Cell.C2, Cell.C3, Cell.C4,
+        Cell.C5, Cell.C6, Cell.C7, Cell.C8,
+    ]
+
+    def __init__(
+        self,
+        robot: Robot,
+        finder: FindImage,
+        board: Board,
+        topleft,
+        minecount: Optional[int] = None,
+        capture: str = "fullscreen",
+        classify: str = "cells",
+        threads: int = 0,
+        verify: bool = False,
+    ):
+        """minecount is the number of mines on the board, None if not
+        known.
+
+        capture is fullscreen, board (only the board is captured) or dirty
+        (only the cells around the last clicks are captured).
+
+        classify is cells (identify_cell per cell) or board (identify_board
+        on the whole image, with identify_cell for the cells it is unsure
+        of).
+
+        threads > 1 identifies cells on a pool of that many threads.
+
+        Cells are matched against what they likely show first, guided by
+        what they showed before; verify matches every template instead."""
         self.robot: Robot = robot
         self.finder: FindImage = finder
         self.board: Board = board
         self.nwx, self.nwy = topleft
+        self.capture = capture
+        self.classify = classify
+        self.threads = threads
+        self.verify = verify
+        # mouse travel saved by ordering the clicks, in pixels
+        self.distance_saved = 0.0
+        self.__pool: Optional[ThreadPoolExecutor] = None
+        self.__frame: Optional[Image] = None  # board image, for dirty
+        self.__dirty: Set[Point] = set()  # cells clicked since a capture
+        self.__clicked: Set[Point] = set()  # cells clicked since get_state
+        # the last image read, and the cells whose value was read from it
+        self.__seen: Optional[Image] = None
+        self.__prefetched: Optional[Future] = None  # capture in flight
+        self.__fresh = np.zeros((board.rows, board.cols), dtype=np.bool_)
+        # the cell last read at each position, and how often each was read
+        self.__cells = np.full((board.rows, board.cols), None, dtype=object)
+        self.__counts: Counter = Counter()
+        self.__minecount = minecount
         super().__init__(board.rows, board.cols, minecount=1)
+        # digest of the status face while the game is on
+        self.__status: Optional[bytes] = None
+        if finder.status is not None:
+            self.__status = self._status_digest()
+
+    @property
+    def minecount(self) -> Optional[int]:
+        return self.__minecount
 
     def location(self, cellx, celly) -> Tuple[int, int]:
         def mid_point(slice_r):
@@ -101,29 +279,256 @@ class RobotMinesweeper(Minesweeper):
         ys, xs = self.board.cell_dims(cellx, celly)
         return (self.nwx + mid_point(xs), self.nwy + mid_point(ys))
 
+    BUTTONS = {
+        Action.OPEN: "left",
+        Action.MARK: "right",
+        Action.UNMARK: "right",
+        Action.CHORD: "both",
+    }
+
     def click(self, xy: Point, action: Action) -> None:
-        if action != Action.OPEN:
-            raise NotImplementedError(f"{action} not implemented")
+        if action not in RobotMinesweeper.BUTTONS:
+            raise ValueError(f"Unknown action {action}")
 
         px, py = self.location(*xy)
         rpx, rpy = self.robot.move_to(px, py)
         if rpx != px or rpy != py:
             raise ValueError(f"Could not move to {px, py}")
-        self.robot.click()
-
-    def _screencap(self):
-        w, h = board.boardwidth, board.boardheight
-        image = self.robot.screencap()
-        return image[self.nwy:self.nwy+h, self.nwx:self.nwx+w]
+        self.robot.click(RobotMinesweeper.BUTTONS[action])
+        self.__touch(xy, action)
+        # flags are not re-read from the screen for cells the solver knows
+        if action == Action.MARK:
+            self[xy] = Minesweeper.FLAG
+        elif action == Action.UNMARK:
+            self[xy] = Minesweeper.UNOPENED
+
+    def click_all_async(self, moves: List[Tuple[Point, Action]]) -> Future:
+        """click_all on the robot thread of an AsyncRobot, then a capture for
+        the next get_state queued right behind the clicks."""
+        clicks = self.robot.submit(self.click_all, moves)
+        if self.capture != "dirty" or self.__frame is None:
+            self.__prefetched = self.robot.submit(self._screencap)
+        return clicks
+
+    def click_all(self, moves: List[Tuple[Point, Action]]) -> None:
+        """Sends all the moves to the robot in a single batch, ordered along
+        a short mouse path from where the mouse is."""
+        start = None if self.robot.lastpos == (-1, -1) else self.robot.lastpos
+        ordered = order_moves(moves, start, self.location)
+        self.distance_saved += (
+            path_length(moves, start, self.location)
+            - path_length(ordered, start, self.location)
+        )
+        moves = ordered
+        ops = []
+        for xy, action in moves:
+            if action not in RobotMinesweeper.BUTTONS:
+                raise ValueError(f"Unknown action {action}")
+            px, py = self.location(*xy)
+            ops.append(("move", px, py))
+            ops.append(("click", RobotMinesweeper.BUTTONS[action]))
+        positions = self.robot.batch(ops)
+        for op, pos in zip(ops, positions):
+            if op[0] == "move" and pos != op[1:]:
+                raise ValueError(f"Could not move to {op[1:]}")
+        if len(positions) != len(ops):
+            raise ValueError("batch stopped early")
+        for xy, action in moves:
+            self.__touch(xy, action)
+            if action == Action.MARK:
+                self[xy] = Minesweeper.FLAG
+            elif action == Action.UNMARK:
+                self[xy] = Minesweeper.UNOPENED
+
+    def __touch(self, xy: Point, action: Action) -> None:
+        "Notes the cells a click may change."
+        self.__dirty.add(xy)
+        self.__clicked.add(xy)
+        if action == Action.CHORD:
+            self.__dirty.update(self.neighbor_xys(xy))
+            self.__clicked.update(self.neighbor_xys(xy))
+
+    def _capture_board(self) -> Image:
+        "The prefetched capture if there is one, else a new one."
+        prefetched, self.__prefetched = self.__prefetched, None
+        if prefetched is not None:
+            return prefetched.result()
+        return self._screencap()
+
+    def _screencap(self) -> Image:
+        w, h = self.board.boardwidth, self.board.boardheight
+        if self.capture == "fullscreen":
+            image = self.robot.screencap()
+            return image[self.nwy:self.nwy+h, self.nwx:self.nwx+w]
+        return self.robot.screencap(self.nwx, self.nwy, w, h)
+
+    def _recapture(self, rect: Tuple[int, int, int, int]) -> None:
+        "Captures the cells in rows r0..r1, cols c0..c1 into the frame."
+        r0, c0, r1, c1 = rect
+        ys, xs = self.board.cell_dims(r0, c0)
+        ye, xe = self.board.cell_dims(r1, c1)
+        x, y = xs.start, ys.start
+        w, h = xe.stop - x, ye.stop - y
+        patch = self.robot.screencap(self.nwx + x, self.nwy + y, w, h)
+        ph, pw = patch.shape[:2]
+        self.__frame[y:y+ph, x:x+pw] = patch
+
+    def _status_digest(self) -> bytes:
+        x, y, w, h = self.finder.status
+        face = np.ascontiguousarray(self.robot.screencap(x, y, w, h))
+        return blake2b(face.tobytes(), digest_size=16).digest()
+
+    def _check_status(self) -> None:
+        """Raises GameSolvedError or GameExplodedError once the status face
+        differs from the one at the start of the game.  A mine in one of the
+        cells clicked tells a loss from a win."""
+        clicked, self.__clicked = self.__clicked, set()
+        if self.__status is None or self._status_digest() == self.__status:
+            return
+        image = self._capture_board()
+        for xy in clicked:
+            if self.finder.shows_mine(self.board.cell_image(image, *xy)):
+                raise GameExplodedError()
+        raise GameSolvedError()
 
     def get_state(self, points: List[Point] = None) -> List[Tuple[Point, int]]:
-        image = self._screencap()
+        self._check_status()
         if points is None:
             points = [(i, j) for i in range(self.m) for j in range(self.n)]
+        if self.capture != "dirty":
+            self._identify(self._capture_board(), points)
+        elif self.__frame is None:
+            # the first capture has the whole board
+            self.__frame = np.array(self._capture_board())
+            self.__dirty.clear()
+            self._identify(self.__frame, points)
+        elif self.__dirty:
+            self._identify_dirty(set(points))
+
+        return [
+            ((i, j), self[i, j])
+            for i in range(self.m) for j in range(self.n)
+            if self[i, j] != Minesweeper.UNOPENED
+        ]
+
+    def _identify_dirty(self, points: Set[Point]) -> None:
+        """Recaptures and identifies the cells around the clicked cells, one
+        bounding rectangle per cluster of them.  A revealed 0 opens its
+        neighbours, so those not captured yet are captured in turn."""
+        pending = self._bounding_rects(self.__dirty)
+        self.__dirty = set()
+        done: Set[Point] = set()
+        while pending:
+            r0, c0, r1, c1 = rect = pending.pop()
+            self._recapture(rect)
+            cells = [
+                (i, j)
+                for i in range(r0, r1 + 1) for j in range(c0, c1 + 1)
+                if (i, j) not in done
+            ]
+            done.update(cells)
+            cells = [xy for xy in cells if xy in points]
+            self._identify(self.__frame, cells)
+            cascade = {
+                nxy
+                for xy in cells if self[xy] == 0
+                for nxy in self.neighbor_xys(xy) if nxy not in done
+            }
+            pending.extend(self._bounding_rects(cascade))
+
+    @staticmethod
+    def _bounding_rects(cells: Set[Point]) -> List[Tuple[int, int, int, int]]:
+        "Bounding (r0, c0, r1, c1) of each group of touching cells."
+        rects = []
+        todo = set(cells)
+        while todo:
+            group = [todo.pop()]
+            for i, j in group:
+                nbrs = {
+                    (i + di, j + dj)
+                    for di in (-1, 0, 1) for dj in (-1, 0, 1)
+                } & todo
+                todo -= nbrs
+                group.extend(nbrs)
+            rows = [i for i, _ in group]
+            cols = [j for _, j in group]
+            rects.append((min(rows), min(cols), max(rows), max(cols)))
+        return rects
+
+    def _changed_cells(
+        self, image: Image, rect: Tuple[int, int, int, int]
+    ) -> np.ndarray:
+        """A mask of the cells in rect, (r0, c0, r1, c1), whose pixels differ
+        from the last read.  Their pixels are kept for the next read; only
+        rect is compared and copied."""
+        r0, c0, r1, c1 = rect
+        ys, xs = self.board.cell_dims(r0, c0)
+        ye, xe = self.board.cell_dims(r1, c1)
+        rows, cols = slice(ys.start, ye.stop), slice(xs.start, xe.stop)
+        shape = (r1 - r0 + 1, c1 - c0 + 1)
+        if self.__seen is None or self.__seen.shape != image.shape:
+            self.__seen = np.array(image)
+            return np.ones(shape, dtype=np.bool_)
+        area, seen = image[rows, cols], self.__seen[rows, cols]
+        if area.shape[:2] != (ye.stop - ys.start, xe.stop - xs.start):
+            seen[...] = area
+            return np.ones(shape, dtype=np.bool_)
+        diff = area != seen
+        seen[...] = area
+        return diff.reshape(
+            shape[0], ys.stop - ys.start, shape[1], xs.stop - xs.start, -1
+        ).any(axis=(1, 3, 4))
+
+    def _identify(self, image: Image, points: List[Point]) -> None:
+        """Reads the cells at points from image, a capture of the board.
+        Cells whose pixels are the same as when they were last read keep
+        their value."""
+        if not points:
+            return
+        r0, r1 = min(i for i, _ in points), max(i for i, _ in points)
+        c0, c1 = min(j for _, j in points), max(j for _, j in points)
+        fresh = self.__fresh[r0:r1 + 1, c0:c1 + 1]
+        changed = self._changed_cells(image, (r0, c0, r1, c1))
+        unread = ~fresh | changed
+        points = [(i, j) for i, j in points if unread[i - r0, j - c0]]
+        fresh &= ~changed
+        board_cells = np.full((self.m, self.n), None, dtype=object)
+        if self.classify == "board" and points:
+            # only the rectangle around points is classified
+            r0, r1 = min(i for i, _ in points), max(i for i, _ in points)
+            c0, c1 = min(j for _, j in points), max(j for _, j in points)
+            ys, xs = self.board.cell_dims(r0, c0)
+            ye, xe = self.board.cell_dims(r1, c1)
+            area = Board(
+                (xe.stop - xs.start, ye.stop - ys.start),
+                (xs.stop - xs.start, ys.stop - ys.start),
+            )
+            board_cells[r0:r1 + 1, c0:c1 + 1] = self.finder.identify_board(
+                image[ys.start:ye.stop, xs.start:xe.stop], area
+            )
+        if self.threads > 1:
+            # cells that look alike are read once
+            alike: Dict[bytes, List[Point]] = {}
+            for xy in points:
+                if board_cells[xy] is None:
+                    pixels = self.board.cell_image(image, *xy).tobytes()
+                    alike.setdefault(pixels, []).append(xy)
+            todo = [xys[0] for xys in alike.values()]
+            if self.__pool is None:
+                self.__pool = ThreadPoolExecutor(self.threads)
+            read = lambda xy: self._read_cell(image, xy)  # noqa: E731
+            for xys, found in zip(alike.values(), self.__pool.map(read, todo)):
+                for xy in xys:
+                    board_cells[xy] = found
         for i, j in points:
             cellimg: Image = self.board.cell_image(image, i, j)
             try:
-                cell: Cell = self.finder.identify_cell(cellimg)
+                cell = board_cells[i, j]
+                if isinstance(cell, SubImageNotFoundError):
+                    raise cell
+                cell = cell or self.finder.identify_cell(
+                    cellimg, self._prior((i, j)), self.verify
+                )
             except SubImageNotFoundError as e:
                 if (result := self.finder.is_game_ended(image)):
                     if result == "FINISHED":
@@ -140,14 +545,36 @@ class RobotMinesweeper(Minesweeper):
                 raise ValueError("cell identification error", e)
             count: int = RobotMinesweeper.to_count(cell)
             self[i, j] = count
+            self.__cells[i, j] = cell
+            self.__counts[cell] += 1
+            self.__fresh[i, j] = True
             if count == Minesweeper.MINE:
                 raise self._explode((i, j))
 
-        return [
-            ((i, j), self[i, j])
-            for i in range(self.m) for j in range(self.n)
-            if self[i, j] != Minesweeper.UNOPENED
-        ]
+    def _read_cell(
+        self, image: Image, xy: Point
+    ) -> Union[Cell, SubImageNotFoundError]:
+        "identify_cell for the pool, returning the error rather than raising."
+        try:
+            return self.finder.identify_cell(
+                self.board.cell_image(image, *xy), self._prior(xy), self.verify
+            )
+        except SubImageNotFoundError as e:
+            return e
+
+    def _prior(self, xy: Point) -> List[Cell]:
+        """The cells xy likely shows, most likely first.  A known cell
+        shows what it did, an unopened one that changed was opened, and
+        numbers go by how often they have been read."""
+        last = self.__cells[xy]
+        numbers = sorted(self.NUMBERS, key=lambda c: -self.__counts[c])
+        if self[xy] == Minesweeper.FLAG:
+            return [Cell.FLAG, Cell.UNOPENED]
+        if last is None:
+            return [Cell.UNOPENED, Cell.FLAG] + numbers
+        if last == Cell.UNOPENED:
+            return numbers
+        return [last]
 
     @staticmethod
     def to_count(cell: Cell) -> int:
@@ -167,26 +594,174 @@ class RobotMinesweeper(Minesweeper):
         }[cell]
 
 
-def play(robot, rm, selector, actions, limit, refresh):
-    solver = MineSolver(rm)
+def play(
+    robot, rm, selector, actions, limit, refresh, workers=0, stats=None,
+    pipeline=False,
+):
+    """stats, if given, collects the moves settled by each solver engine,
+    the z3 runs made ahead while pipelining and the safe cells they
+    found, and the clicks saved by chording.
+
+    pipeline overlaps solving with the robot's clicks and captures; rm
+    must then drive an AsyncRobot."""
+    solver = MineSolver(rm, workers=workers)
+    if stats is None:
+        stats = Counter()
+    try:
+        if pipeline:
+            _play_pipelined(
+                solver, rm, selector, actions, limit, refresh, stats
+            )
+        else:
+            _play(solver, rm, selector, actions, limit, refresh, stats)
+    finally:
+        solver.close()
+        stats.update(solver.engine_counts)
+
+
+def path_length(
+    moves: List[Tuple[Point, Action]],
+    start: Optional[Tuple[int, int]],
+    location: Callable[[int, int], Tuple[int, int]],
+) -> float:
+    "Distance the mouse travels from start through the moves."
+    points = [location(*xy) for xy, _ in moves]
+    if start is not None:
+        points.insert(0, start)
+    return sum(
+        ((x1 - x0) ** 2 + (y1 - y0) ** 2) ** 0.5
+        for (x0, y0), (x1, y1) in zip(points, points[1:])
+    )
+
+
+def order_moves(
+    moves: List[Tuple[Point, Action]],
+    start: Optional[Tuple[int, int]],
+    location: Callable[[int, int], Tuple[int, int]],
+) -> List[Tuple[Point, Action]]:
+    """moves reordered to shorten the mouse path from start, by nearest
+    neighbour then 2-opt.  location maps a cell to its mouse position.
+
+    The flags a chord needs stay right before the chord; such a group is
+    placed by the position of the chord, as its flags are next to it.  A
+    chord relying on flags placed for an earlier chord joins that group,
+    so it still comes after them.
+    """
+    jobs: List[List[Tuple[Point, Action]]] = []
+    job: List[Tuple[Point, Action]] = []
+    placed: Dict[Point, int] = {}  # flagged cell -> job that flags it
+    for move in moves:
+        job.append(move)
+        if move[1] == Action.MARK:
+            continue
+        if move[1] == Action.CHORD:
+            (x, y) = move[0]
+            needs = sorted({
+                placed[(x + dx, y + dy)]
+                for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                if (x + dx, y + dy) in placed
+            })
+            job = [m for k in needs for m in jobs[k]] + job
+            for k in needs:
+                jobs[k] = []
+            placed.update(
+                (xy, len(jobs)) for xy, action in job if action == Action.MARK
+            )
+        jobs.append(job)
+        job = []
+    jobs = [j for j in jobs if j]
+    if len(jobs) < 2:
+        return moves
+    tail = job  # flags with no chord after them keep their place last
+
+    points = np.array([location(*job[-1][0]) for job in jobs], dtype=float)
+    if start is not None:
+        points = np.vstack([start, points])
+    diff = points[:, None, :] - points[None, :, :]
+    dist = np.hypot(diff[..., 0], diff[..., 1])
+
+    # nearest neighbour, from start or else from the first job
+    path = [0]
+    left = set(range(1, len(points)))
+    while left:
+        here = dist[path[-1]]
+        nearest = min(left, key=lambda k: here[k])
+        path.append(nearest)
+        left.remove(nearest)
+
+    # 2-opt on the open path, the first node fixed: reverse path[i:j+1]
+    # for the j that shortens it most, for each i in turn
+    path = np.array(path)
+    dist = np.pad(dist, ((0, 1), (0, 1)))  # to a dummy node after the end
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(path) - 1):
+            a, b = path[i - 1], path[i]
+            cs = path[i + 1:]
+            ds = np.append(path[i + 2:], len(points))
+            gain = dist[a, b] + dist[cs, ds] - dist[a, cs] - dist[b, ds]
+            j = int(gain.argmax())
+            if gain[j] > 1e-9:
+                path[i:i + j + 2] = path[i:i + j + 2][::-1].copy()
+                improved = True
+
+    offset = 0 if start is None else 1
+    order = [k - offset for k in path.tolist() if k >= offset]
+    return [move for k in order for move in jobs[k]] + tail
+
+
+def _move(solver, rm, selector, actions, stats, unmines):
+    """The clicks opening unmines, or a guess when there are none, and the
+    number of cells they open.  Raises GameSolvedError once no unknown
+    cell is left."""
+    if len(unmines) == 0:
+        if next(solver.unknowns(), None) is None:
+            raise GameSolvedError()
+        point, p_mine = guess(solver, selector)
+        print(f"guessing... {point} p(mine)={p_mine:.3f}")
+        actions.append(0)
+        return [(point, Action.OPEN)], 1
+    print(f"opening...  {unmines}")
+    actions.append(len(unmines))
+    moves, saved = plan_moves(solver, rm, unmines)
+    stats["saved"] += saved
+    return moves, len(unmines)
+
+
+def _play(solver, rm, selector, actions, limit, refresh, stats):
     i = 0
     while i < limit:
         unmines = solver.update_board_state(fetch_full_board=refresh)
-        if len(unmines) == 0:
-            unknowns = list(solver.unknowns())
-            if len(unknowns) == 0:
-                raise GameSolvedError()
-            point = selector(unknowns)
-            print(f"guessing... {point}")
-            actions.append(0)
-            rm.click(point, Action.OPEN)
-            i += 1
-        else:
-            print(f"opening...  {unmines}")
-            actions.append(len(unmines))
-            for point in unmines:
-                rm.click(point, Action.OPEN)
-            i += len(unmines)
+        moves, opened = _move(solver, rm, selector, actions, stats, unmines)
+        rm.click_all(moves)
+        i += opened
+    raise ValueError("too many moves")
+
+
+def _play_pipelined(solver, rm, selector, actions, limit, refresh, stats):
+    """_play with the robot working in the background.  The capture for the
+    next move is queued behind each batch of clicks.  While they run, z3
+    looks for the forced cells the rules missed, and the safe ones join
+    the next move's clicks."""
+    i = 0
+    ahead: Set[Point] = set()  # safe cells found while the robot worked
+    while i < limit:
+        unmines = solver.update_board_state(
+            fetch_full_board=refresh, safe=ahead
+        )
+        ahead = set()
+        moves, opened = _move(solver, rm, selector, actions, stats, unmines)
+        clicks = rm.click_all_async(moves)
+        if solver.engine == "rules":
+            mines, safe = solver.solve_z3()
+            stats["z3_ahead"] += 1
+            for minexy in mines:
+                solver.add_known(minexy, MineSolver.MINE)
+            ahead = set(safe) - set(unmines)
+            stats["ahead"] += len(ahead)
+        clicks.result()
+        i += opened
     raise ValueError("too many moves")
 
 
@@ -195,60 +770,85 @@ if __name__ == "__main__":
     from random import choice
 
     # Parse CLI args
-    default_args = '8888 first fullscreen 300 True online'.split()
+    default_args = (
+        '8888 first fullscreen 300 True online 0 none raw /dev/shm/minesweeper'
+        ' cells 0 False False'
+    ).split()
     args = sys.argv[1:] + default_args[len(sys.argv) - 1:]
     port = int(args[0])
     selector = (lambda lst: lst[0]) if args[1] == 'first' else choice
-    screencap = 'fullscreen' if args[2] == 'fullscreen' else 'board'
+    screencap = args[2]  # fullscreen, board or dirty
     maxmoves = int(args[3])
     refresh = args[4].lower() == 'true'
     finder_cls = FindImageMinesweeperOnline
     if args[5] == 'native':
         finder_cls = FindImageMacnative
-
-    robot = Robot(port)
+    workers = int(args[6])
+    # the board's mine count, none if not known
+    minecount = None if args[7] in ('none', 'auto') else int(args[7])
+    image_format = args[8]
+    framebuffer = args[9]
+    classify = args[10]  # cells or board
+    # threads identifying cells, auto for one per core
+    threads = os.cpu_count() if args[11] == 'auto' else int(args[11])
+    pipeline = args[12].lower() == 'true'
+    verify = args[13].lower() == 'true'  # match every template per cell
+
+    robot = Robot(port, image_format, framebuffer)
+    if pipeline:
+        robot = AsyncRobot(robot)
     p = print
     print = lambda *args: p(*args, file=sys.stderr)
     actions = []
+    stats = Counter()  # engine per move and clicks saved by chording
     start_time_ns = time.perf_counter_ns()
 
-    # count number of times we call finder.get_matches
     finder = finder_cls()
-    counter = [0]
-    def count_it(fn):
-        """Counts number of times a function is called."""
-        def cfn(*args, **kwargs):
-            counter[0] += 1
-            return fn(*args, **kwargs)
-        return cfn
-    finder.get_matches = count_it(finder.get_matches)
 
+    # board corners from the last run, checked before searching again
+    corners_file = ".board_corners.json"
+    try:
+        with open(corners_file) as f:
+            saved = json.load(f).get(finder_cls.__name__)
+        finder.corners = {k: tuple(v) for k, v in saved.items()}
+    except (OSError, ValueError, AttributeError):
+        pass
     (nwx, nwy), board = finder.get_new_board(robot.screencap())
-    rm = RobotMinesweeper(robot, finder, board, (nwx, nwy))
-
-    if screencap == 'board':
-        def _screencap():
-            w, h = board.boardwidth, board.boardheight
-            image = robot.screencap(nwx, nwy, w, h)
-            return image
-        rm._screencap = _screencap
+    with open(corners_file, "w") as f:
+        json.dump({finder_cls.__name__: finder.corners}, f)
+    rm = RobotMinesweeper(
+        robot, finder, board, (nwx, nwy), minecount,
+        capture=screencap, classify=classify, threads=threads,
+        verify=verify,
+    )
 
     def result(message: str, start: int):
         timetaken_ms = int((time.perf_counter_ns() - start) // 1e6)
         gametype = (
             f"{['1st','Rnd'][selector == choice]}"
-            f"{['Full','Bord'][screencap == 'board']}"
+            f"{dict(fullscreen='Full', board='Bord', dirty='Dirt')[screencap]}"
             f"{['Unko', 'Refr'][refresh]}"
         )
         clicks = robot.total_clicks
         distance = robot.total_distance
+        unordered = distance + int(rm.distance_saved)
         bandwidth = robot.total_bandwidth
         guesses = sum((1 for c in actions if c == 0))
+        print(f"cell cache hits={finder.cache_hits}"
+              f" misses={finder.cache_misses}")
+        print("bandwidth by format " + " ".join(
+            f"{name}={size}" for name, size in sorted(robot.bandwidth.items())
+        ))
         # type result timetaken clicks guesses matchTemplate bandwidth
+        # distance unordered rules z3 z3ahead ahead saved
         p(
             f"| {gametype:11s} | {message:8s} | {timetaken_ms:7d} |"
             f" {clicks:6d} | {guesses:7d} |"
-            f" {counter[0]:10d} | {bandwidth:9d} | {distance:7d} |"
+            f" {finder.matches:10d} | {bandwidth:9d} | {distance:8d} |"
+            f" {unordered:9d} |"
+            f" {stats['rules']:5d} | {stats['z3']:5d} |"
+            f" {stats['z3_ahead']:7d} | {stats['ahead']:5d} |"
+            f" {stats['saved']:5d} |"
         )
 
     try:
@@ -259,6 +859,9 @@ if __name__ == "__main__":
             actions=actions,
             limit=maxmoves,
             refresh=refresh,
+            workers=workers,
+            stats=stats,
+            pipeline=pipeline,
         )
     except GameSolvedError:
         result(message="solved", start=start_time_ns)
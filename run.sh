@@ -39,12 +39,12 @@ DEBUGFILE="debug.log"
 
 date >> $LOGFILE
 
-echo '| game mode   | result   | time ms | clicks | guesses | imgMatches | bandwidth |'
+echo '| game mode   | result   | time ms | clicks | guesses | imgMatches | bandwidth | distance | unordered | rules |    z3 | z3ahead | ahead | saved |'
 i=1
 while true; do
 for MODE in first random; do
     restart_robot_server
-    for SCREENCAP in fullscreen board; do
+    for SCREENCAP in fullscreen board dirty; do
         for REFRESH_BOARD in False True; do
             if [[ $i -gt $COUNT ]]; then
                 break 4
@@ -0,0 +1,36 @@
+from minesweeper import (
+    MAX_LAYOUT_CELLS,
+    mine_probabilities,
+)
+
+
+def linked_units(units, row=0):
+    """Constraints of a chain of units, each with 6 cells and exactly 3
+    mines, whose densest constraints add up to 3.5 mines per unit."""
+    constraints = []
+    for i in range(units):
+        a, b, c, d, e, f = [(row, 6 * i + j) for j in range(6)]
+        constraints += [([a, b, c], 2), ([a, d], 1), ([b, e], 1), ([c, f], 1)]
+        if i:
+            constraints.append(([(row, 6 * i - 1), d], 1))
+    return constraints
+
+
+def test_mine_probabilities_large_component():
+    # 60 cells with 30 mines, estimated at 35 by the densest constraints
+    constraints = linked_units(10)
+    assert 6 * 10 > MAX_LAYOUT_CELLS
+    interior = [(9, j) for j in range(28)]
+    probs = mine_probabilities(constraints, interior, minesleft=34)
+    assert all(0 <= p <= 1 for p in probs.values())
+    assert len({probs[pt] for pt in interior}) == 1
+
+
+def test_mine_probabilities_large_and_small_components():
+    constraints = linked_units(10) + linked_units(1, row=1)
+    interior = [(9, j) for j in range(28)]
+    probs = mine_probabilities(constraints, interior, minesleft=37)
+    assert len(probs) == 60 + 6 + 28
+    assert all(0 <= p <= 1 for p in probs.values())
+    # the small component is enumerated: 3 mines among its 6 cells
+    assert abs(sum(probs[(1, j)] for j in range(6)) - 3) < 1e-9
@@ -0,0 +1,48 @@
+from bench import (
+    new_game,
+)
+from minesweeper import (
+    Action,
+    Minesweeper,
+    MineSolver,
+    guess,
+    plan_moves,
+)
+from play import (
+    order_moves,
+)
+
+
+def location(i, j):
+    return j * 24, i * 24
+
+
+def test_order_moves_keeps_shared_flags_first():
+    moves = [((0, 5), Action.MARK), ((0, 4), Action.CHORD),
+             ((0, 6), Action.CHORD)]
+    ordered = order_moves(moves, (300, 0), location)
+    assert sorted(ordered) == sorted(moves)
+    assert ordered.index(((0, 5), Action.MARK)) == 0
+
+
+def test_order_moves_opens_every_planned_cell():
+    for seed in range(10):
+        ms = new_game(16, 30, 99, seed)
+        solver = MineSolver(ms)
+        ms.click((8, 15), Action.OPEN)
+        try:
+            while True:
+                unmines = solver.update_board_state(fetch_full_board=False)
+                if not unmines:
+                    if next(solver.unknowns(), None) is None:
+                        break
+                    point, _ = guess(solver, lambda lst: lst[0])
+                    ms.click(point, Action.OPEN)
+                    continue
+                moves, _ = plan_moves(solver, ms, unmines)
+                ms.click_all(order_moves(moves, (0, 0), location))
+                assert all(ms[pt] != Minesweeper.UNOPENED for pt in unmines)
+        except ValueError as e:  # a guess exploded
+            assert str(e).startswith("Exploded")
+        finally:
+            solver.close()